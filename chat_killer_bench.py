@@ -0,0 +1,506 @@
+# Load generator and latency benchmark for the chat killer server
+#
+# Spawns the server (or targets a running one) and drives it with simulated players that speak the same
+# framed protocol as chat_killer_client.py: USERNAME handshake, Admin login, chat, @USR private messages,
+# !list and the Admin's @USR !suspend / @USR !forgive. Every chat message and PM carries the time it was
+# sent, so each copy a player receives gives one delivery latency sample.
+#
+#   python3 chat_killer_bench.py --clients 2000 --rate 5000 --duration 30
+#   python3 chat_killer_bench.py --clients 2000 --rate 5000 --workers 4 --json results.json
+#   python3 chat_killer_bench.py --clients 2000 --rate 5000 --tls
+import asyncio
+import argparse
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from chat_killer_protocol import HEARTBEAT, FrameDecoder, FrameError, RECV_SIZE, encode_frame, recv_frame
+try:
+    import resource  # Only available on Unix, used to raise the open-files limit
+except ImportError:
+    resource = None
+try:
+    import uvloop  # Optional faster event loop, keeps the load generator from being the bottleneck
+except ImportError:
+    uvloop = None
+
+
+#-------------------------------------------------#
+# Benchmark configuration
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_killer_server.py')
+ADMIN_USERNAME = "Admin"
+ADMIN_PASSWORD = "admin123"
+STAMP = b'ts='  # Marks the send time (perf_counter_ns) at the end of a chat message or PM
+SERVER_START_TIMEOUT = 10  # Seconds to wait for a spawned server to accept connections
+DRAIN_TIME = 1.0  # Seconds to keep reading after the last message so late deliveries are counted
+
+
+#-------------------------------------------------#
+# Measurements
+
+stats = {
+    'connected': 0,  # Players that completed the handshake
+    'connect_failures': 0,
+    'sent': 0,  # Chat messages and PMs sent
+    'commands': 0,  # !list and Admin commands sent
+    'received': 0,  # Frames received by all players
+    'disconnected': 0,  # Players the server closed during the run
+}
+latencies = []  # Delivery latencies in nanoseconds, one per received stamped frame
+setup_times = []  # Seconds from connect() to the reply that proves the player is in its room
+rss_samples = []  # Resident set size of the server processes in KiB
+
+def percentile(samples, fraction):
+    """Return the value below which the given fraction of the sorted samples falls."""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def server_rss(pid):
+    """Return the RSS in KiB of a server process and its children (the workers and broker of --workers N)."""
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+            with open(f'/proc/{current}/task/{current}/children') as children:
+                pids.extend(int(child) for child in children.read().split())
+        except (OSError, ValueError):
+            continue  # Not Linux, or the process already exited
+    return total
+
+def raise_open_files_limit(count):
+    """Raise the soft limit on open file descriptors so the simulated players fit in this process."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = count + 64
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (ValueError, OSError) as e:
+        print(f"Could not raise open files limit: {e}", file=sys.stderr)
+
+
+#-------------------------------------------------#
+# Simulated players
+
+class Player:
+    """One simulated connection: a reader task that records deliveries and a writer used by the load loop."""
+
+    def __init__(self, USERNAME, room=None):
+        self.USERNAME = USERNAME
+        self.room = room
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.replies = deque()  # Unstamped frames received during the login, awaited by expect()
+
+    async def connect(self, host, port, password=None, tls=None):
+        """Open the connection, log in and wait until the server has placed the player in its room."""
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port, ssl=tls)
+        self.writer.write(encode_frame(self.USERNAME))
+        if password is not None:
+            await self.expect(b"Enter the password")
+            self.writer.write(encode_frame(password))
+            await self.expect(b"Password correct")
+        else:
+            if self.room is not None:
+                self.writer.write(encode_frame(f"!join {self.room}"))  # Sent at once, the server handles it after the login
+            await self.expect(b"Welcome, ")  # The login confirmation, whatever the size of the lobby
+            if self.room is not None:
+                await self.expect(b"You ")  # "You created ..." or "You joined ..."
+        setup_times.append(time.perf_counter() - started)
+
+    async def read_frames(self, first=False):
+        """Read until the connection closes (or, with first, until a reply arrives), timing stamped frames."""
+        while True:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection.")
+            frames = self.decoder.feed(data)
+            now = time.perf_counter_ns()
+            for frame in frames:
+                if not frame:
+                    self.writer.write(HEARTBEAT)  # Pong, or the server closes idle players
+                    continue
+                stats['received'] += 1
+                index = frame.rfind(STAMP)
+                if index >= 0:
+                    try:
+                        latencies.append(now - int(frame[index + len(STAMP):]))
+                        continue
+                    except ValueError:
+                        pass
+                if first:
+                    self.replies.append(frame)  # Replies during the run are only counted
+            if first and self.replies:
+                return
+
+    async def expect(self, prefix):
+        """Wait for the next unstamped frame that starts with prefix during the handshake."""
+        while True:
+            while not self.replies:
+                await self.read_frames(first=True)
+            if self.replies.popleft().startswith(prefix):
+                return
+
+    async def receive(self):
+        """Keep reading for the rest of the run."""
+        try:
+            await self.read_frames()
+        except (ConnectionError, OSError, FrameError):
+            stats['disconnected'] += 1
+
+    def send(self, message):
+        self.writer.write(encode_frame(message))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def room_of(arguments, index):
+    """Return the room of the index-th player, or None when everyone stays in the lobby."""
+    if arguments.room_size <= 0:
+        return None
+    return f"{arguments.prefix}-room{index // arguments.room_size}"
+
+async def connect_players(arguments, players):
+    """Connect every player with bounded concurrency and return the connection setup rate."""
+    gate = asyncio.Semaphore(arguments.connect_concurrency)
+
+    async def connect_one(player):
+        async with gate:
+            try:
+                await asyncio.wait_for(player.connect(arguments.host, arguments.port, tls=arguments.tls_context),
+                                       arguments.timeout)
+                stats['connected'] += 1
+            except (OSError, ConnectionError, FrameError, asyncio.TimeoutError):
+                stats['connect_failures'] += 1
+                player.close()
+                player.writer = None
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect_one(player) for player in players))
+    return stats['connected'] / max(time.perf_counter() - started, 1e-9)
+
+
+async def pause(seconds, deadline):
+    """Sleep for seconds, but not past the end of the load phase, which would stretch load_time."""
+    await asyncio.sleep(max(min(seconds, deadline - time.perf_counter()), 0))
+
+
+async def drive_player(arguments, player, peers, deadline):
+    """Send chat messages, PMs and !list at this player's share of the total rate until the deadline."""
+    interval = arguments.clients / arguments.rate
+    await pause(random.uniform(0, interval), deadline)  # Spread the players over the first interval
+    sequence = 0
+    while time.perf_counter() < deadline and not player.writer.is_closing():
+        draw = random.random()
+        if draw < arguments.list_ratio:
+            player.send("!list")
+            stats['commands'] += 1
+        elif draw < arguments.list_ratio + arguments.pm_ratio and peers:
+            target = random.choice(peers)
+            player.send(f"@{target.USERNAME} pm {sequence} {STAMP.decode()}{time.perf_counter_ns()}")
+            stats['sent'] += 1
+        else:
+            player.send(f"chat {sequence} {STAMP.decode()}{time.perf_counter_ns()}")
+            stats['sent'] += 1
+        sequence += 1
+        await pause(random.expovariate(1 / interval), deadline)
+
+
+async def drive_admin(arguments, admin, players, deadline):
+    """Suspend, forgive and list players on a fixed interval, the moderator's share of the load."""
+    while time.perf_counter() < deadline and not admin.writer.is_closing():
+        await pause(arguments.admin_interval, deadline)
+        if time.perf_counter() >= deadline:
+            break
+        target = random.choice(players)
+        admin.send(f"@{target.USERNAME} !suspend")
+        admin.send(f"@{target.USERNAME} !forgive")
+        admin.send("!list")
+        stats['commands'] += 3
+
+
+async def sample_rss(pid, deadline):
+    while pid is not None and time.perf_counter() < deadline:
+        rss_samples.append(server_rss(pid))
+        await pause(0.5, deadline)
+
+
+#-------------------------------------------------#
+# Benchmark run
+
+def spawn_server(arguments):
+    """Start chat_killer_server.py on the benchmark port and wait until it accepts connections."""
+    command = [sys.executable, SERVER_SCRIPT, str(arguments.port)]
+    if arguments.use_async:
+        command.append('--async')
+    if arguments.workers:
+        command += ['--workers', str(arguments.workers)]
+    if arguments.tls:
+        command += ['--tls-cert', arguments.tls_cert]
+        if arguments.tls_key:
+            command += ['--tls-key', arguments.tls_key]
+    command += shlex.split(arguments.server_args)
+    log = open(arguments.server_log, 'a') if arguments.server_log else subprocess.DEVNULL
+    # Own session, so the workers and broker of --workers N can be stopped together
+    server = subprocess.Popen(command, stdout=log, stderr=log, start_new_session=True)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with status {server.returncode}.")
+        try:
+            socket.create_connection((arguments.host, arguments.port), timeout=0.5).close()
+            time.sleep(0.2)  # The probe is a half-finished login, let the workers register with the broker
+            return server
+        except OSError:
+            time.sleep(0.1)
+    stop_server(server)
+    raise RuntimeError(f"Server did not accept connections within {SERVER_START_TIMEOUT} seconds.")
+
+def stop_server(server):
+    """Wait for a spawned server to exit after !shutdown, and stop its whole process group otherwise."""
+    try:
+        server.wait(5)
+        return
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(5)
+    except (OSError, subprocess.TimeoutExpired):
+        server.kill()
+        server.wait()
+
+async def run_benchmark(arguments, server_pid):
+    players = [Player(f"{arguments.prefix}{index}", room_of(arguments, index)) for index in range(arguments.clients)]
+    admin = None
+    if arguments.admin:
+        admin = Player(ADMIN_USERNAME)
+        await asyncio.wait_for(admin.connect(arguments.host, arguments.port, ADMIN_PASSWORD, arguments.tls_context),
+                               arguments.timeout)
+
+    idle_rss = server_rss(server_pid) if server_pid else None
+    connect_rate = await connect_players(arguments, players)
+    players = [player for player in players if player.writer is not None]
+    if not players:
+        raise RuntimeError("No player could connect.")
+    connected_rss = server_rss(server_pid) if server_pid else None
+
+    # Latencies are only counted from here on, join notifications are not part of the load
+    latencies.clear()
+    for key in ('sent', 'commands', 'received'):
+        stats[key] = 0
+    receivers = [asyncio.create_task(player.receive()) for player in players + ([admin] if admin else [])]
+    started = time.perf_counter()
+    deadline = started + arguments.duration
+    rooms = {}  # PMs go to players of the same room, like chat
+    for player in players:
+        rooms.setdefault(player.room, []).append(player)
+    drivers = [drive_player(arguments, player, rooms[player.room], deadline) for player in players]
+    if admin is not None:
+        drivers.append(drive_admin(arguments, admin, players, deadline))
+    drivers.append(sample_rss(server_pid, deadline))
+    await asyncio.gather(*drivers)
+    load_time = time.perf_counter() - started
+    await asyncio.sleep(DRAIN_TIME)
+    elapsed = time.perf_counter() - started
+    disconnected = stats['disconnected']  # Before the shutdown below closes everyone
+
+    if admin is not None and arguments.shutdown:
+        admin.send("!shutdown")
+        await asyncio.sleep(0.2)
+    for task in receivers:
+        task.cancel()
+    for player in players:
+        player.close()
+    if admin is not None:
+        admin.close()
+
+    latencies.sort()
+    milliseconds = lambda value: None if value is None else round(value / 1e6, 3)
+    return {
+        'clients': arguments.clients,
+        'connected': stats['connected'],
+        'connect_failures': stats['connect_failures'],
+        'disconnected_during_run': disconnected,
+        'connection_setup_per_sec': round(connect_rate, 1),
+        'setup_p50_ms': round(percentile(sorted(setup_times), 0.5) * 1000, 3),
+        'setup_p99_ms': round(percentile(sorted(setup_times), 0.99) * 1000, 3),
+        'target_rate': arguments.rate,
+        'sent_per_sec': round(stats['sent'] / load_time, 1),
+        'commands_per_sec': round(stats['commands'] / load_time, 1),
+        'delivered_per_sec': round(stats['received'] / elapsed, 1),
+        'latency_samples': len(latencies),
+        'latency_p50_ms': milliseconds(percentile(latencies, 0.5)),
+        'latency_p99_ms': milliseconds(percentile(latencies, 0.99)),
+        'latency_p999_ms': milliseconds(percentile(latencies, 0.999)),
+        'latency_max_ms': milliseconds(latencies[-1] if latencies else None),
+        'server_rss_idle_kib': idle_rss,
+        'server_rss_connected_kib': connected_rss,
+        'server_rss_peak_kib': max(rss_samples) if rss_samples else None,
+    }
+
+#-------------------------------------------------#
+# TLS handshake cost (--tls)
+
+def create_certificate(directory):
+    """Write a throwaway self-signed certificate for 127.0.0.1 and localhost with the openssl command."""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                    '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+                    '-keyout', keyfile, '-out', certfile], check=True, capture_output=True)
+    return certfile, keyfile
+
+def create_client_context(arguments):
+    """Return the players' SSLContext, trusting --tls-cert (or anything when benchmarking a server we did not start)."""
+    context = ssl.create_default_context(cafile=arguments.tls_cert)
+    if arguments.tls_cert is None:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+def open_tls(arguments, session=None):
+    sock = socket.create_connection((arguments.host, arguments.port), arguments.timeout)
+    try:
+        return arguments.tls_context.wrap_socket(sock, server_hostname=arguments.host, session=session)
+    except (OSError, ValueError):
+        sock.close()
+        raise
+
+def measure_handshakes(arguments):
+    """Time --handshakes TCP connects plus TLS handshakes one after another: full ones, then resumed ones."""
+    # A TLS 1.3 session ticket arrives after the handshake: log in once so the client has read it
+    probe = open_tls(arguments)
+    probe.sendall(encode_frame(f"{arguments.prefix}-tls"))
+    recv_frame(probe, FrameDecoder())
+    session = probe.session
+    probe.close()
+
+    results = {}
+    for kind, offered in (('full', None), ('resumed', session)):
+        times = []
+        reused = 0
+        for _ in range(arguments.handshakes):
+            started = time.perf_counter()
+            sock = open_tls(arguments, offered)
+            times.append(time.perf_counter() - started)
+            reused += sock.session_reused
+            sock.close()
+        times.sort()
+        results[f'tls_{kind}_handshake_p50_ms'] = round(percentile(times, 0.5) * 1000, 3)
+        results[f'tls_{kind}_handshake_p99_ms'] = round(percentile(times, 0.99) * 1000, 3)
+        results[f'tls_{kind}_handshakes_per_sec'] = round(len(times) / sum(times), 1)
+        if offered is not None:
+            results['tls_resumed_fraction'] = round(reused / len(times), 3)
+    return results
+
+def print_report(results):
+    width = max(len(key) for key in results)
+    for key, value in results.items():
+        print(f"{key:<{width}} : {'n/a' if value is None else value}")
+
+
+#-------------------------------------------------#
+# Command line
+
+def parse_arguments(argv):
+    """Parse the command-line arguments of the benchmark."""
+    parser = argparse.ArgumentParser(prog="python3 chat_killer_bench.py",
+                                     description="Load and latency benchmark for the chat killer server.")
+    parser.add_argument('--host', default='127.0.0.1', help="server address (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=5555, help="server port (default: %(default)s)")
+    parser.add_argument('--clients', type=int, default=1000, help="simulated players (default: %(default)s)")
+    parser.add_argument('--rate', type=float, default=1000,
+                        help="chat messages, PMs and !list per second over all players (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load (default: %(default)s)")
+    parser.add_argument('--room-size', type=int, default=20,
+                        help="players per room, chat fans out to the room; 0 keeps everyone in the lobby "
+                             "(default: %(default)s)")
+    parser.add_argument('--pm-ratio', type=float, default=0.1, help="share of PMs (default: %(default)s)")
+    parser.add_argument('--list-ratio', type=float, default=0.01, help="share of !list (default: %(default)s)")
+    parser.add_argument('--admin-interval', type=float, default=1.0,
+                        help="seconds between the Admin's !suspend/!forgive/!list rounds (default: %(default)s)")
+    parser.add_argument('--no-admin', dest='admin', action='store_false', help="do not log in as Admin")
+    parser.add_argument('--connect-concurrency', type=int, default=256,
+                        help="handshakes in flight while connecting (default: %(default)s)")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds allowed per handshake (default: %(default)s)")
+    parser.add_argument('--prefix', default='bench', help="USERNAME prefix of the players (default: %(default)s)")
+    parser.add_argument('--no-spawn', dest='spawn', action='store_false',
+                        help="benchmark a server that is already running instead of starting one")
+    parser.add_argument('--server-pid', type=int, help="PID of an already running server, to report its RSS")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="start the server with --async")
+    parser.add_argument('--workers', type=int, default=0, help="start the server with --workers N")
+    parser.add_argument('--server-args', default='',
+                        help="more options for the spawned server, e.g. \"--log-level INFO --log-queue\"")
+    parser.add_argument('--server-log', help="file receiving the spawned server's log (default: discarded)")
+    parser.add_argument('--json', dest='json_path', help="also write the results to this JSON file")
+    parser.add_argument('--tls', action='store_true',
+                        help="connect the players over TLS and time full and resumed handshakes")
+    parser.add_argument('--tls-cert', help="certificate of the server (default: a throwaway self-signed one, "
+                                           "made with the openssl command for the spawned server)")
+    parser.add_argument('--tls-key', help="private key of --tls-cert for the spawned server")
+    parser.add_argument('--handshakes', type=int, default=200,
+                        help="sequential TLS handshakes timed of each kind, 0 to skip (default: %(default)s)")
+    arguments = parser.parse_args(argv)
+    if arguments.clients < 1 or arguments.rate <= 0 or arguments.duration <= 0:
+        parser.error("--clients, --rate and --duration must be positive")
+    arguments.shutdown = arguments.spawn  # Only stop servers this benchmark started
+    arguments.tls_context = None
+    return arguments
+
+def main(argv=None):
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
+    raise_open_files_limit(arguments.clients + 1)
+    certificate_directory = None
+    if arguments.tls:
+        if arguments.tls_cert is None and arguments.spawn:
+            certificate_directory = tempfile.TemporaryDirectory()
+            arguments.tls_cert, arguments.tls_key = create_certificate(certificate_directory.name)
+        arguments.tls_context = create_client_context(arguments)
+    server = spawn_server(arguments) if arguments.spawn else None
+    server_pid = server.pid if server is not None else arguments.server_pid
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        handshakes = measure_handshakes(arguments) if arguments.tls and arguments.handshakes > 0 else {}
+        results = asyncio.run(run_benchmark(arguments, server_pid))
+        results.update(handshakes)
+    finally:
+        if server is not None:
+            stop_server(server)
+        if certificate_directory is not None:
+            certificate_directory.cleanup()
+    print_report(results)
+    if arguments.json_path:
+        with open(arguments.json_path, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+#-------------------------------------------------#
+if __name__ == "__main__":                        #
+    main()                                        #
+#-------------------------------------------------#
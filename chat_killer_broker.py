@@ -0,0 +1,212 @@
+# Local broker connecting the worker processes of a multi-process chat killer server (--workers N)
+#
+# Every worker accepts players on the same port through SO_REUSEPORT and keeps one Unix-domain connection
+# to the broker. Workers publish envelopes (joins, leaves, state changes, broadcasts, PMs, moderator
+# commands); the broker keeps the global directory of players and relays or routes each envelope.
+import socket
+import selectors
+import os
+import json
+import logging
+from collections import Counter, deque
+from chat_killer_protocol import HEADER, FrameDecoder, RECV_SIZE
+
+
+#-------------------------------------------------#
+# Broker configuration
+
+MAX_ENVELOPE_SIZE = 1024 * 1024  # An envelope carries a client frame plus a small JSON header
+RELAYED_KINDS = {'join', 'leave', 'state', 'broadcast', 'room', 'ban'}  # Sent to every other worker
+ROUTED_KINDS = {'deliver', 'command'}  # Sent to the worker that owns the USERNAME of the envelope
+
+
+#-------------------------------------------------#
+# Envelopes: a JSON header line followed by an optional raw body (usually an encoded client frame)
+
+def encode_envelope(kind, body=b'', **fields):
+    """Return the frame of one broker envelope."""
+    fields['kind'] = kind
+    header = json.dumps(fields, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(len(header) + 1 + len(body)) + header + b'\n' + body
+
+def decode_envelope(frame):
+    """Split an envelope frame into its header dictionary and raw body."""
+    header, _, body = frame.partition(b'\n')
+    return json.loads(header), body
+
+
+#-------------------------------------------------#
+# Worker side helpers
+
+def create_broker_socket(path):
+    """Bind the broker's listening Unix-domain socket; done before forking so workers can connect at once."""
+    if os.path.exists(path):
+        os.unlink(path)  # Left over from a previous run
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+def connect_to_broker(path, worker_id):
+    """Connect a worker to the broker and introduce it."""
+    link = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    link.connect(path)
+    link.sendall(encode_envelope('hello', worker=worker_id))
+    return link
+
+
+#-------------------------------------------------#
+# Broker process
+
+workers = {}  # Worker socket -> {'worker', 'decoder', 'outbox'}
+worker_sockets = {}  # Worker id -> socket
+directory = {}  # USERNAME -> {'worker': id, 'state': 'active'/'suspended', 'room': name}, the global roster
+rooms = {}  # Room name -> {'moderator': USERNAME, 'game_active': bool}
+room_sizes = Counter()  # Room name -> number of players in it, used to forget empty rooms
+permanent_rooms = set()  # Rooms that stay even when empty (the default room)
+
+def move_player(USERNAME, room_name):
+    """Update the room of a player in the directory and forget the room it left if it became empty."""
+    entry = directory[USERNAME]
+    previous = entry.get('room')
+    if previous == room_name:
+        return
+    entry['room'] = room_name
+    if room_name is not None:
+        room_sizes[room_name] += 1
+    if previous is not None:
+        room_sizes[previous] -= 1
+        if room_sizes[previous] <= 0 and previous not in permanent_rooms:
+            rooms.pop(previous, None)
+            del room_sizes[previous]
+
+def queue_to_worker(worker_socket, frame):
+    """Queue an envelope for a worker; the broker never blocks on a slow worker."""
+    details = workers.get(worker_socket)
+    if details is not None:
+        details['outbox'].append(frame)
+
+def flush_worker(worker_socket, selector):
+    """Write what the socket accepts and watch it for writability while output remains."""
+    outbox = workers[worker_socket]['outbox']
+    while outbox:
+        try:
+            sent = worker_socket.send(outbox[0])
+        except (BlockingIOError, InterruptedError):
+            break
+        if sent < len(outbox[0]):
+            outbox[0] = outbox[0][sent:]
+            break
+        outbox.popleft()
+    events = selectors.EVENT_READ | selectors.EVENT_WRITE if outbox else selectors.EVENT_READ
+    if selector.get_key(worker_socket).events != events:
+        selector.modify(worker_socket, events)
+
+def handle_envelope(worker_socket, frame):
+    """Update the directory from one envelope and relay or route it. Return False on shutdown."""
+    header, _ = decode_envelope(frame)
+    kind = header['kind']
+    sender = workers[worker_socket]
+    envelope = HEADER.pack(len(frame)) + frame  # Re-framed once, the same bytes go to every receiving worker
+
+    if kind == 'hello':
+        sender['worker'] = header['worker']
+        worker_sockets[header['worker']] = worker_socket
+        queue_to_worker(worker_socket, encode_envelope('sync', directory=directory, rooms=rooms))
+        return True
+    if kind == 'join':
+        owner = directory.get(header['USERNAME'])
+        if owner is not None and owner['worker'] != sender['worker']:
+            # Two workers accepted the same USERNAME at once, the later one gives it up
+            queue_to_worker(worker_socket, encode_envelope('evict', USERNAME=header['USERNAME']))
+            return True
+        directory[header['USERNAME']] = {'worker': sender['worker'], 'state': header['state'], 'room': None}
+        move_player(header['USERNAME'], header['room'])
+    elif kind == 'leave':
+        owner = directory.get(header['USERNAME'])
+        if owner is None or owner['worker'] != sender['worker']:
+            return True  # An evicted duplicate leaving, the directory keeps the real owner
+        move_player(header['USERNAME'], None)
+        del directory[header['USERNAME']]
+    elif kind == 'state':
+        if header['USERNAME'] in directory:
+            directory[header['USERNAME']]['state'] = header['state']
+            move_player(header['USERNAME'], header['room'])
+    elif kind == 'room':
+        rooms[header['room']] = {'moderator': header['moderator'], 'game_active': header['game_active']}
+    elif kind == 'shutdown':
+        for other in workers:
+            if other is not worker_socket:
+                queue_to_worker(other, envelope)
+        return False
+
+    if kind in RELAYED_KINDS:
+        for other in workers:
+            if other is not worker_socket:
+                queue_to_worker(other, envelope)
+    elif kind in ROUTED_KINDS:
+        owner = directory.get(header['USERNAME'])
+        if owner is not None and owner['worker'] in worker_sockets:
+            queue_to_worker(worker_sockets[owner['worker']], envelope)
+    return True
+
+def close_worker(worker_socket, selector):
+    """Forget a worker that exited, together with the players it was hosting."""
+    details = workers.pop(worker_socket)
+    worker_sockets.pop(details['worker'], None)
+    selector.unregister(worker_socket)
+    worker_socket.close()
+    for USERNAME in [name for name, entry in directory.items() if entry['worker'] == details['worker']]:
+        move_player(USERNAME, None)
+        del directory[USERNAME]
+        for other in workers:
+            queue_to_worker(other, encode_envelope('leave', USERNAME=USERNAME))
+    logging.info(f"Worker {details['worker']} left the broker.")
+
+def run_broker(listener, path, initial_rooms):
+    """Relay envelopes between workers until they have all exited or one of them shuts the server down."""
+    rooms.update(initial_rooms)
+    permanent_rooms.update(initial_rooms)
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    running = True
+    seen_worker = False
+    try:
+        while running and (workers or not seen_worker):
+            for key, mask in selector.select():
+                notified_socket = key.fileobj
+                if notified_socket is listener:
+                    worker_socket, _ = listener.accept()
+                    worker_socket.setblocking(False)
+                    workers[worker_socket] = {'worker': None, 'decoder': FrameDecoder(MAX_ENVELOPE_SIZE),
+                                              'outbox': deque()}
+                    selector.register(worker_socket, selectors.EVENT_READ)
+                    seen_worker = True
+                    continue
+                if notified_socket not in workers:
+                    continue
+                if mask & selectors.EVENT_READ:
+                    try:
+                        data = notified_socket.recv(RECV_SIZE)
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError:
+                        data = b''
+                    if not data:
+                        close_worker(notified_socket, selector)
+                        continue
+                    for frame in workers[notified_socket]['decoder'].feed(data):
+                        running = handle_envelope(notified_socket, frame) and running
+            for worker_socket in list(workers):
+                try:
+                    flush_worker(worker_socket, selector)
+                except OSError:
+                    close_worker(worker_socket, selector)
+    finally:
+        for worker_socket in list(workers):
+            worker_socket.close()
+        selector.close()
+        listener.close()
+        if os.path.exists(path):
+            os.unlink(path)
+        logging.info("Broker stopped.")
@@ -1,9 +1,28 @@
 import socket
+import selectors
+import ssl
 import sys
+import argparse
 import threading
 import logging
-logging.basicConfig(filename='client.log', filemode='a', level=logging.DEBUG,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+import heapq
+import itertools
+import time
+from collections import deque
+from chat_killer_protocol import HEARTBEAT, FrameDecoder, FrameError, RECV_SIZE, encode_frame, recv_frame
+
+RECV_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)  # Read without blocking while other threads keep sending with sendall()
+CONNECT_TIMEOUT = 5  # Seconds allowed to open a connection and to finish the login
+RECONNECT_DELAY = 1.0  # First wait before reconnecting a lost session, doubled after each failed attempt
+MAX_RECONNECT_DELAY = 30.0
+TLS_SEND_TIMEOUT = 10  # Seconds a send on a TLS connection may wait for room in the socket buffer
+LOGIN_REFUSALS = ("USERNAME already in use", "Server is full", "Incorrect password", "Login timed out",
+                  "You have been banned", "USERNAME is longer", "USERNAME cannot be empty")
+# Refusals that logging in again cannot fix: the session gives up instead of reconnecting
+PERMANENT_REFUSALS = ("Incorrect password", "You have been banned", "USERNAME is longer", "USERNAME cannot be empty",
+                      "The server asked for a password")
+# First message of an accepted login: "Welcome, USERNAME." for a player, "Password correct..." for the Admin
+LOGIN_CONFIRMATIONS = ("Welcome, ", "Password correct")
 
 #-------------------------------------------------#
 
@@ -14,86 +33,524 @@ def clear_line():
 
 #-------------------------------------------------#
 
-def receive_messages(sock,run_flag):
-    """Continuously listen for messages from the server using a non-blocking socket."""
-    sock.setblocking(0)  # Set socket to non-blocking mode
+def show_message(message):
+    """Print a message from the server above the input prompt."""
+    clear_line()  # Clear the input line before showing the new message
+    print(message.decode('utf-8', errors='replace'))
+    sys.stdout.write("Enter your message or command: ")
+    sys.stdout.flush()  # Make sure the prompt is displayed
 
-    try:
-        while run_flag['active']:
+class ClientReactor:
+    """Receive side of any number of client connections, served by one thread blocked in a selector.
+
+    An idle reactor sleeps in epoll/kqueue and uses no CPU. Each connection is registered with a callback
+    called once per received message and an optional callback called once when it closes, with the error
+    that closed it (None when the server closed it). Sockets can keep blocking mode for sendall().
+    An SSLSocket is registered non-blocking with the lock its senders hold (see send_tls()): one TLS
+    connection must not read and write from two threads at once.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        self.calls = deque()  # Calls made from other threads, run by the reactor thread
+        self.timers = []  # Heap of (deadline, sequence, callback, args) for call_later()
+        self.timer_sequence = itertools.count()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+    def call_soon(self, callback, *args):
+        """Run callback(*args) in the reactor thread; safe to call from any thread."""
+        self.calls.append((callback, args))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # A wakeup is already pending, or the reactor is closed
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) in the reactor thread after delay seconds; safe to call from any thread."""
+        entry = (time.monotonic() + delay, next(self.timer_sequence), callback, args)
+        self.call_soon(heapq.heappush, self.timers, entry)
+
+    def add(self, sock, on_message, on_close=None, decoder=None, lock=None):
+        """Start receiving the frames of a connected socket, holding lock (if given) while reading it."""
+        self.call_soon(self._register, sock, (decoder or FrameDecoder(), on_message, on_close, lock))
+
+    def remove(self, sock):
+        """Stop receiving from a socket without closing it."""
+        self.call_soon(self._unregister, sock)
+
+    def stop(self):
+        self.call_soon(setattr, self, 'running', False)
+
+    def _register(self, sock, data):
+        decoder, on_message, _, _ = data
+        self.selector.register(sock, selectors.EVENT_READ, data)
+        while decoder.backlog:  # Frames that arrived together with the login replies
+            on_message(decoder.backlog.popleft())
+
+    def _unregister(self, sock):
+        if sock.fileno() != -1 and sock in self.selector.get_map():
+            self.selector.unregister(sock)
+
+    def _closed(self, sock, on_close, error):
+        self.selector.unregister(sock)
+        if on_close is not None:
+            on_close(error)
+
+    def run_once(self, timeout=None):
+        """Wait for events up to timeout seconds (forever with None), dispatch them, then run due calls."""
+        if self.timers:
+            delay = max(self.timers[0][0] - time.monotonic(), 0)
+            timeout = delay if timeout is None else min(timeout, delay)
+        for key, _ in self.selector.select(timeout):
+            sock = key.fileobj
+            if sock is self.wakeup_reader:
+                try:
+                    while sock.recv(4096):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+                continue
+            decoder, on_message, on_close, lock = key.data
             try:
-                message = sock.recv(1024)
-                if message:
-                    clear_line()  # Clear the input line before showing the new message
-                    print(message.decode('utf-8'))
-                    sys.stdout.write("Enter your message or command: ")
-                    sys.stdout.flush()  # Make sure the prompt is displayed
+                if lock is None:
+                    data = sock.recv(RECV_SIZE, RECV_FLAGS)
                 else:
-                    # No more data from server
-                    print("Server has disconnected.")
-                    break
-            except BlockingIOError:
-                # No data available, yield control to allow typing or other operations
+                    with lock:  # A record is at most 16 KiB, one recv() drains it
+                        data = sock.recv(RECV_SIZE)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError):
                 continue
-            except socket.error as e:
-                if run_flag['active']:
-                    #print(f"Socket errorTest: {e}")
-                    break
-            except Exception as e:
-                if run_flag['active']:
-                    print(f"Unexpected error: {e}")
-                    break
+            except OSError as e:
+                self._closed(sock, on_close, e)
+                continue
+            if not data:
+                self._closed(sock, on_close, None)  # No more data from server
+                continue
+            try:
+                messages = decoder.feed(data)
+            except FrameError as e:
+                self._closed(sock, on_close, e)
+                continue
+            for message in messages:  # One recv can carry several messages
+                on_message(message)
+        # Every queued call wrote a wakeup byte, so the select above returned at once for it
+        while self.calls:
+            callback, args = self.calls.popleft()
+            callback(*args)
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
+    def run(self):
+        """Dispatch events until stop() is called."""
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def close(self):
+        self.selector.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+
+def receive_messages(sock, run_flag, decoder, lock=None):
+    """Show the messages from the server until it disconnects, blocking in a selector while idle."""
+    reactor = ClientReactor()
+    outcome = {}
+
+    def on_close(error):
+        outcome['error'] = error
+        reactor.stop()
+
+    def on_message(message):
+        if message:
+            show_message(message)
+        elif lock is None:
+            sock.sendall(HEARTBEAT)  # Answer the server's ping
+        else:
+            with lock:
+                send_tls(sock, HEARTBEAT)
+
+    reactor.add(sock, on_message, on_close, decoder, lock)
+    try:
+        reactor.run()
+        error = outcome.get('error')
+        if error is None:
+            print("Server has disconnected.")
+        elif isinstance(error, FrameError):
+            print(f"Protocol error: {error}")
+        elif run_flag['active']:
+            logging.error(f"Socket error while receiving: {str(error)}")
+    except Exception as e:
+        if run_flag['active']:
+            print(f"Unexpected error: {e}")
     finally:
+        reactor.close()
         print("Cleaning up connection...")
         sock.close()
         print("You are now disconnected. Please close the terminal manually or press Enter or double Enter to exit.")
         input()  # Wait for the user to press Enter
 
+#-------------------------------------------------#
+# Headless client API, for bots and tools
+
+def send_tls(sock, data):
+    """sendall() on a TLS socket that the reactor reads without blocking; call it holding the socket's lock."""
+    sock.settimeout(TLS_SEND_TIMEOUT)
+    try:
+        sock.sendall(data)
+    finally:
+        sock.setblocking(False)  # A record holding only a session ticket must not block the reactor's recv()
+
+
+class LoginError(ConnectionError):
+    """Raised when the server refuses a login or does not answer it in time."""
+
+
+def create_tls_context(cafile=None, verify=True):
+    """Return a client SSLContext for a server started with --tls-cert.
+
+    cafile is the certificate (or CA) to trust besides the system ones; verify=False accepts any certificate,
+    for self-signed test setups only.
+    """
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class ChatKillerClient:
+    """One headless chat session: login, chat, PMs and commands, with server messages delivered to callbacks.
+
+    Callbacks run in the reactor thread of the pool: on_message(client, text), on_connect(client) after each
+    successful login and on_disconnect(client, error). A lost session logs in again with exponential
+    backoff while reconnect is true, unless the server refuses the login for good (banned, wrong password):
+    on_disconnect then gets a LoginError. Without a pool the client starts a private one.
+
+    With tls (an SSLContext, see create_tls_context()) the connection is encrypted; the TLS session of the
+    last login is offered again on reconnect, so the server can resume it and skip the full handshake.
+    """
+
+    def __init__(self, host, port, USERNAME, password=None, on_message=None, on_connect=None,
+                 on_disconnect=None, reconnect=True, pool=None, tls=None):
+        self.host = host
+        self.port = port
+        self.USERNAME = USERNAME
+        self.password = password  # Answers the server's password prompt (the Admin login)
+        self.on_message = on_message
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.reconnect = reconnect
+        self.owns_pool = pool is None
+        self.pool = pool if pool is not None else ChatKillerPool()
+        self.sock = None
+        self.state = 'disconnected'  # 'login' while the server checks the USERNAME, then 'joined'; 'closed' at the end
+        self.refusal = None  # Reason given by the server for refusing the last login
+        self.login_done = threading.Event()
+        self.send_lock = threading.Lock()  # Keeps frames sent from several threads whole
+        self.retrying = False
+        self.reconnect_delay = RECONNECT_DELAY
+        self.tls = tls
+        self.tls_session = None  # Session of the last TLS connection, offered for resumption
+        self.tls_resumed = False  # Whether the server resumed the session on the current connection
+
+    def connect(self, timeout=CONNECT_TIMEOUT, wait=True):
+        """Open the connection and log in; with wait, block until logged in or raise LoginError."""
+        self.pool.start()
+        self.retrying = False
+        self._open(timeout)
+        if wait:
+            self.wait_logged_in(timeout)
+
+    def wait_logged_in(self, timeout=CONNECT_TIMEOUT):
+        if not self.login_done.wait(timeout):
+            raise LoginError(f"No login reply from the server within {timeout} seconds.")
+        if self.state != 'joined':
+            raise LoginError(self.refusal or "The server closed the connection during the login.")
+
+    def login(self):
+        """Send the USERNAME; the server answers with a confirmation, a refusal or the password prompt."""
+        self.refusal = None
+        self._send_frame(self.USERNAME)
+
+    def send(self, message):
+        """Send a chat message, or any command typed as in the terminal client."""
+        self._send_frame(message)
+
+    def pm(self, recipients, message):
+        """Send a private message to one USERNAME or a list of them."""
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        self.send(" ".join(f"@{recipient}" for recipient in recipients) + " " + message)
+
+    def list(self):
+        """Ask for the roster of the room; the reply comes through on_message."""
+        self.send("!list")
+
+    def moderate(self, command, USERNAME):
+        """Run a moderator command ('ban', 'suspend' or 'forgive') on a player."""
+        self.send(f"@{USERNAME} !{command}")
+
+    def logout(self):
+        self.state = 'closed'
+        self.send("!logout")  # The server says goodbye and closes the connection
+
+    def close(self):
+        """End the session for good, without reconnecting."""
+        self.state = 'closed'
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)  # The reactor sees the end of the stream and cleans up
+            except OSError:
+                pass
+        if self.owns_pool:
+            self.pool.close()
+
+    def _send_frame(self, message):
+        if self.sock is None:
+            raise ConnectionError(f"{self.USERNAME} is not connected.")
+        with self.send_lock:
+            if self.tls is None:
+                self.sock.sendall(encode_frame(message))
+            else:
+                send_tls(self.sock, encode_frame(message))
+
+    def _open(self, timeout):
+        self._attach(*self._dial(timeout))
+
+    def _dial(self, timeout):
+        """Open the TCP connection and run the TLS handshake, blocking; return the socket and its reactor lock."""
+        sock = socket.create_connection((self.host, self.port), timeout)
+        lock = None
+        if self.tls is not None:
+            try:
+                # The handshake runs here, within the connect timeout
+                sock = self.tls.wrap_socket(sock, server_hostname=self.host, session=self.tls_session)
+            except (OSError, ValueError):
+                sock.close()
+                raise
+            self.tls_resumed = sock.session_reused
+            sock.setblocking(False)
+            lock = self.send_lock
+        else:
+            sock.settimeout(None)
+        return sock, lock
+
+    def _attach(self, sock, lock):
+        """Hand a connected socket to the reactor and start the login."""
+        self.sock = sock
+        self.state = 'login'
+        self.login_done.clear()
+        self.pool.reactor.add(sock, self._received, self._closed, lock=lock)
+        self.login()
+
+    def _received(self, message):
+        if not message:
+            self._send_frame(b'')  # Answer the server's ping, the session stays alive while nobody talks
+            return
+        text = message.decode('utf-8', errors='replace')
+        if self.state == 'login':
+            if text.startswith("Enter the password"):
+                if self.password is None:
+                    self.refusal = "The server asked for a password."
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                else:
+                    self._send_frame(self.password)
+                return
+            if text.startswith(LOGIN_REFUSALS):
+                self.refusal = text  # The server closes the connection right after
+                return
+            if not text.startswith(LOGIN_CONFIRMATIONS):
+                logging.warning(f"Unexpected message during the login of {self.USERNAME}: {text}")
+                return
+            self.state = 'joined'
+            if self.tls is not None:
+                self.tls_session = self.sock.session  # TLS 1.3 tickets arrive after the handshake, they are in by now
+            self.retrying = False
+            self.reconnect_delay = RECONNECT_DELAY
+            self.login_done.set()
+            logging.info(f"{self.USERNAME} logged in to {self.host} : {self.port}.")
+            if self.on_connect is not None:
+                self.on_connect(self)
+            return  # The confirmation answers login(), not something the caller asked for
+        if self.on_message is not None:
+            self.on_message(self, text)
+
+    def _closed(self, error):
+        self.sock.close()
+        previous = self.state
+        if previous == 'closed':
+            if self.on_disconnect is not None:
+                self.on_disconnect(self, error)
+            return
+        self.state = 'disconnected'
+        if previous == 'login':
+            self.login_done.set()
+            logging.info(f"Login of {self.USERNAME} failed: {self.refusal or error}.")
+            if not self.retrying:
+                return  # connect() reports it to the caller
+            if self.refusal is not None and self.refusal.startswith(PERMANENT_REFUSALS):
+                self.retrying = False
+                if self.on_disconnect is not None:
+                    self.on_disconnect(self, LoginError(self.refusal))
+                return
+        else:
+            logging.info(f"{self.USERNAME} lost the connection: {error}.")
+            if self.on_disconnect is not None:
+                self.on_disconnect(self, error)
+        if self.reconnect:
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        self.retrying = True
+        self.pool.reactor.call_later(self.reconnect_delay, self._reconnect)
+        self.reconnect_delay = min(self.reconnect_delay * 2, MAX_RECONNECT_DELAY)
+
+    def _reconnect(self):
+        if self.state == 'closed':
+            return
+        # Connecting blocks for up to CONNECT_TIMEOUT plus the TLS handshake: never in the reactor thread,
+        # where every other session of the pool would stop receiving and answering pings meanwhile
+        threading.Thread(target=self._redial, name=f"chat-killer-reconnect-{self.USERNAME}", daemon=True).start()
+
+    def _redial(self):
+        try:
+            sock, lock = self._dial(CONNECT_TIMEOUT)
+        except (OSError, ValueError) as e:
+            logging.info(f"Reconnecting {self.USERNAME} failed: {str(e)}.")
+            self.pool.reactor.call_soon(self._schedule_reconnect)
+            return
+        self.pool.reactor.call_soon(self._reattach, sock, lock)
+
+    def _reattach(self, sock, lock):
+        if self.state == 'closed':  # close() was called while connecting
+            sock.close()
+            return
+        try:
+            self._attach(sock, lock)
+        except OSError as e:
+            # The socket is registered already: the reactor sees it broken and _closed() schedules the next attempt
+            logging.info(f"Reconnecting {self.USERNAME} failed: {str(e)}.")
+
+
+class ChatKillerPool:
+    """Many ChatKillerClient sessions multiplexed over a single ClientReactor thread."""
+
+    def __init__(self):
+        self.reactor = ClientReactor()
+        self.clients = []
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.reactor.run, name="chat-killer-reactor", daemon=True)
+            self.thread.start()
+
+    def client(self, host, port, USERNAME, **options):
+        """Create a session served by this pool; call connect() on it or connect_all() on the pool."""
+        client = ChatKillerClient(host, port, USERNAME, pool=self, **options)
+        self.clients.append(client)
+        return client
+
+    def connect_all(self, timeout=CONNECT_TIMEOUT):
+        """Log every session in, with all the logins in flight at once."""
+        self.start()
+        for client in self.clients:
+            if client.state in ('disconnected', 'closed'):
+                client.connect(timeout, wait=False)
+        for client in self.clients:
+            client.wait_logged_in(timeout)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        if self.thread is not None:
+            self.reactor.stop()
+            self.thread.join()
+            self.thread = None
+        self.reactor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 #-------------------------------------------------#
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python3 client.py <address> <port>")
-        sys.exit()
+    logging.basicConfig(filename='client.log', filemode='a', level=logging.DEBUG,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(prog="python3 chat_killer_client.py", description="Chat killer game client.")
+    parser.add_argument('address', help="server address")
+    parser.add_argument('port', type=int, help="server port")
+    parser.add_argument('--tls', action='store_true', help="connect to a server started with --tls-cert")
+    parser.add_argument('--cafile', help="certificate to trust for --tls, e.g. the server's self-signed one")
+    parser.add_argument('--insecure', action='store_true', help="with --tls, accept any server certificate")
+    arguments = parser.parse_args()
 
-    server_ip = sys.argv[1]
-    server_port = int(sys.argv[2])
+    server_ip = arguments.address
+    server_port = arguments.port
+    send_lock = None  # Held around every send and receive of a TLS connection
     #sock = None
 
     try:
         # Create a socket and connect to the server
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((server_ip, server_port))
-        print(f"Connected to {server_ip} on port {server_port}")
+        if arguments.tls or arguments.cafile or arguments.insecure:
+            context = create_tls_context(arguments.cafile, verify=not arguments.insecure)
+            sock = context.wrap_socket(sock, server_hostname=server_ip)
+            send_lock = threading.Lock()
+            print(f"Connected to {server_ip} on port {server_port} with {sock.version()}")
+        else:
+            print(f"Connected to {server_ip} on port {server_port}")
 
         USERNAME = input("Enter your USERNAME: ")
         while not USERNAME.strip():
             print("USERNAME cannot be empty. Please enter a valid USERNAME.")
             USERNAME = input("Enter your USERNAME: ")
-        sock.send(USERNAME.encode('utf-8'))
+        sock.sendall(encode_frame(USERNAME))
+        decoder = FrameDecoder()
 
         if USERNAME == "Admin":
-            password_prompt = sock.recv(1024).decode('utf-8')
+            password_prompt = (recv_frame(sock, decoder) or b'').decode('utf-8')
             print(password_prompt, end='')
             password = input()
-            sock.send(password.encode('utf-8'))
-            auth_response = sock.recv(1024).decode('utf-8')
+            sock.sendall(encode_frame(password))
+            auth_response = (recv_frame(sock, decoder) or b'').decode('utf-8')
             print(auth_response)
-            if "Incorrect password" in auth_response:
+            if "Password correct" not in auth_response:
                 sock.close()
                 return
         run_flag = {'active': True}
-        receiver_thread = threading.Thread(target=receive_messages, args=(sock, run_flag))
+        if send_lock is not None:
+            sock.setblocking(False)  # From now on read by the reactor and written with send_tls()
+        receiver_thread = threading.Thread(target=receive_messages, args=(sock, run_flag, decoder, send_lock))
         receiver_thread.start()
 
+        def send(message):
+            if send_lock is None:
+                sock.sendall(encode_frame(message))
+            else:
+                with send_lock:
+                    send_tls(sock, encode_frame(message))
+
         try:
             while True:
                 try:
                     message = input("Enter your message or command: ")
                     if message.lower() == 'quit':
-                        sock.send("logout".encode('utf-8'))
+                        send("logout")
                         logging.info("User has quit.")
                         break
-                    sock.send(message.encode('utf-8'))
+                    send(message)
                 except socket.error as e:
                     logging.error(f"Socket error during send operation: {str(e)}")
                     break
@@ -107,6 +564,11 @@ def main():
             logging.error(f"Critical error: {str(e)}")
         finally:
             if sock:
+                run_flag['active'] = False
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)  # Wakes the receiver thread up from its selector
+                except OSError:
+                    pass
                 sock.close()
                 logging.info("Socket closed.")
     except Exception as e:
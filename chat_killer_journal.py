@@ -0,0 +1,158 @@
+# Append-only journal of the chat killer server (--journal DIR)
+#
+# Joins, leaves, state changes, rooms, bans, chat messages and PMs are appended as JSON lines to the current
+# segment, journal.<n>.log. Records are buffered and written in one batch per loop iteration, then synced
+# according to the fsync policy. Every SNAPSHOT_EVERY records the state they describe is written atomically
+# to snapshot.json and a new segment starts, so a restart loads the snapshot and replays a short tail.
+#
+# The state is what a restart needs to put the games back: rooms with their moderator and started flag,
+# the room and state of every player who was connected, and the banned USERNAMEs.
+import json
+import os
+import time
+
+
+#-------------------------------------------------#
+# Journal configuration
+
+FSYNC_POLICIES = ('always', 'interval', 'never')  # Sync every batch, at most every FSYNC_INTERVAL, or never
+FSYNC_INTERVAL = 1.0
+SNAPSHOT_EVERY = 50000  # Records written before the state is snapshotted and a new segment started
+KEEP_SEGMENTS = 3  # Older segments are kept as message history, the oldest ones are deleted
+SNAPSHOT_FILE = 'snapshot.json'
+HISTORY_PREFIXES = (b'{"kind":"message"', b'{"kind":"pm"')  # Lines replay skips without parsing them
+
+
+def empty_state():
+    return {'rooms': {}, 'players': {}, 'banned': []}
+
+def apply_record(state, record):
+    """Update a replayed state with one record; applying a record twice has no further effect."""
+    kind = record['kind']
+    if kind == 'join' or kind == 'state':
+        state['players'][record['USERNAME']] = {'room': record['room'], 'state': record['state']}
+    elif kind == 'leave':
+        state['players'].pop(record['USERNAME'], None)
+    elif kind == 'room':
+        state['rooms'][record['room']] = {'moderator': record['moderator'], 'game_active': record['game_active']}
+    elif kind == 'discard':
+        state['rooms'].pop(record['room'], None)
+    elif kind == 'ban':
+        state['players'].pop(record['USERNAME'], None)
+        if record['USERNAME'] not in state['banned']:
+            state['banned'].append(record['USERNAME'])
+    # 'message' and 'pm' records are history only
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, f'journal.{number}.log')
+
+def list_segments(directory):
+    """Return the numbers of the segments in a journal directory, in order."""
+    numbers = []
+    for name in os.listdir(directory):
+        parts = name.split('.')
+        if len(parts) == 3 and parts[0] == 'journal' and parts[2] == 'log' and parts[1].isdigit():
+            numbers.append(int(parts[1]))
+    return sorted(numbers)
+
+def replay(directory):
+    """Load the snapshot and replay the segments written after it.
+
+    Return (state, current segment, records replayed, length of the complete records of the current segment).
+    """
+    state = empty_state()
+    segment = 0
+    valid_length = 0
+    snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, 'rb') as snapshot:
+            saved = json.load(snapshot)
+        state = saved['state']
+        segment = saved['segment']
+    replayed = 0
+    for number in list_segments(directory):
+        if number < segment:
+            continue
+        segment = number
+        valid_length = 0
+        with open(segment_path(directory, number), 'rb') as journal_file:
+            for line in journal_file:
+                if not line.endswith(b'\n'):
+                    break  # A torn last line from a crash in the middle of a write
+                if not line.startswith(HISTORY_PREFIXES):  # History does not change the state
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    apply_record(state, record)
+                replayed += 1
+                valid_length += len(line)
+    return state, segment, replayed, valid_length
+
+
+class Journal:
+    """Buffered writer of one journal directory, keeping the replayed state up to date as records are added."""
+
+    def __init__(self, directory, fsync='interval'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync}, expected one of {', '.join(FSYNC_POLICIES)}.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.state, self.segment, self.replayed, valid_length = replay(directory)
+        self.file = open(segment_path(directory, self.segment), 'ab')
+        if self.file.tell() > valid_length:
+            # Cut a torn tail off, or the next record would be glued to it and lost with everything after it
+            self.file.truncate(valid_length)
+        self.batch = []  # Encoded records waiting for the next flush()
+        self.records_since_snapshot = self.replayed
+        self.last_sync = time.monotonic()
+
+    def append(self, kind, **fields):
+        """Add a record to the current batch; it reaches the file on the next flush()."""
+        record = {'kind': kind, 'time': round(time.time(), 3)}  # 'kind' first, so replay can skip history lines
+        record.update(fields)
+        apply_record(self.state, record)
+        self.batch.append(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+        self.records_since_snapshot += 1
+
+    def flush(self):
+        """Write the batch with a single write() and sync it as the fsync policy asks."""
+        if not self.batch:
+            return
+        self.file.write(b''.join(self.batch))
+        self.batch.clear()
+        self.file.flush()
+        now = time.monotonic()
+        if self.fsync == 'always' or (self.fsync == 'interval' and now - self.last_sync >= FSYNC_INTERVAL):
+            os.fsync(self.file.fileno())
+            self.last_sync = now
+        if self.records_since_snapshot >= SNAPSHOT_EVERY:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """Save the state atomically and start a new segment, so the next replay only reads what follows."""
+        self.file.write(b''.join(self.batch))
+        self.batch.clear()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.segment += 1
+        self.file = open(segment_path(self.directory, self.segment), 'ab')
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        temporary_path = snapshot_path + '.tmp'
+        with open(temporary_path, 'w') as snapshot:
+            json.dump({'segment': self.segment, 'state': self.state}, snapshot, separators=(',', ':'))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary_path, snapshot_path)  # Readers see the old snapshot or the new one, never half of one
+        self.records_since_snapshot = 0
+        for number in list_segments(self.directory):
+            if number <= self.segment - KEEP_SEGMENTS:
+                os.unlink(segment_path(self.directory, number))
+
+    def close(self):
+        """Snapshot the state so the next start replays nothing, then close the segment."""
+        self.write_snapshot()
+        self.file.close()
@@ -0,0 +1,88 @@
+# Counters and histograms of the chat killer server
+#
+# Recording a value costs one dictionary update, or one bisect over fixed bucket bounds for histograms, so
+# the event loop can record every accept, frame and command. The server exposes a snapshot on SIGUSR1
+# (written to the log) and, with --stats-port, as JSON on a local TCP port.
+import bisect
+import json
+import os
+import time
+from collections import Counter
+
+
+#-------------------------------------------------#
+# Bucket bounds
+
+SECONDS_BUCKETS = tuple(1e-6 * 2 ** i for i in range(24))  # 1 microsecond up to about 8 seconds
+COUNT_BUCKETS = tuple(2 ** i for i in range(18))  # 1 up to 131072 (fan-out sizes, frames per sendmsg)
+
+
+class Histogram:
+    """Count observations in fixed buckets; percentiles are reported as the upper bound of their bucket."""
+
+    def __init__(self, bounds=SECONDS_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket holds everything above the largest bound
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99), 'p999': self.percentile(0.999),
+                'max': self.max}
+
+
+#-------------------------------------------------#
+# Registry
+
+counters = Counter()
+histograms = {}
+started_at = time.time()
+
+def increment(name, amount=1):
+    counters[name] += amount
+
+def observe(name, value, bounds=SECONDS_BUCKETS):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram(bounds)
+    histogram.observe(value)
+
+def snapshot(gauges=None):
+    """Return every counter, histogram summary and the given gauges as one JSON-ready dictionary."""
+    return {'pid': os.getpid(), 'uptime_seconds': round(time.time() - started_at, 3),
+            'counters': dict(counters), 'gauges': gauges or {},
+            'histograms': {name: histogram.summary() for name, histogram in sorted(histograms.items())}}
+
+def encode_snapshot(gauges=None):
+    return (json.dumps(snapshot(gauges), indent=2, sort_keys=True) + "\n").encode('utf-8')
+
+def format_report(gauges=None):
+    """Return a snapshot as readable lines for the log."""
+    current = snapshot(gauges)
+    lines = [f"Metrics of pid {current['pid']} after {current['uptime_seconds']} s:"]
+    lines += [f"  {name} = {value}" for name, value in sorted(current['counters'].items())]
+    lines += [f"  {name} = {value}" for name, value in sorted(current['gauges'].items())]
+    for name, summary in current['histograms'].items():
+        lines.append(f"  {name}: count={summary['count']} mean={summary['mean']:.6g} p50={summary['p50']:.6g} "
+                     f"p99={summary['p99']:.6g} p999={summary['p999']:.6g} max={summary['max']:.6g}")
+    return "\n".join(lines)
@@ -0,0 +1,85 @@
+# Wire protocol shared by the chat killer server and client
+#
+# Every message travels as one frame: a 4 byte big-endian length followed by that many bytes of UTF-8 text.
+# TCP is a byte stream, so a single recv() can hold several frames or only part of one; FrameDecoder
+# keeps the leftover bytes of each connection until the rest of the frame arrives.
+import struct
+from collections import deque
+
+
+#-------------------------------------------------#
+# Protocol constants
+
+HEADER = struct.Struct('!I')  # Length prefix of every frame
+MAX_FRAME_SIZE = 64 * 1024  # Largest payload accepted from a peer, protects the reassembly buffers
+# Largest payload the server accepts from a client: the server relays chat with the USERNAME in front
+# ("USERNAME: ", "PM from USERNAME: "), and that relayed frame must still fit within MAX_FRAME_SIZE
+MAX_MESSAGE_SIZE = MAX_FRAME_SIZE - 4 * 1024
+RECV_SIZE = 64 * 1024  # Bytes read per recv() call, large enough to pick up many frames at once
+
+
+# Heartbeats: the server sends an empty frame (a ping) to a client it has not heard from for a while and the
+# client answers with an empty frame (a pong). Clients send no other empty frame, and the server answers none.
+HEARTBEAT = HEADER.pack(0)
+
+
+class FrameError(ValueError):
+    """Raised when a peer sends a frame that breaks the protocol."""
+
+
+#-------------------------------------------------#
+# Encoding and decoding
+
+def encode_frame(message):
+    """Return the frame for a message given as str or bytes; raise ValueError if it is too large to send."""
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    if len(message) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {len(message)} bytes is larger than {MAX_FRAME_SIZE} bytes.")
+    return HEADER.pack(len(message)) + message
+
+def encode_frame_parts(*parts):
+    """Return one frame whose payload is the concatenation of several bytes parts, built with a single join."""
+    length = sum(len(part) for part in parts)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes is larger than {MAX_FRAME_SIZE} bytes.")
+    return b''.join((HEADER.pack(length),) + parts)
+
+
+class FrameDecoder:
+    """Reassemble the frames of one connection from the chunks returned by recv()."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+        self.backlog = deque()  # Frames decoded by recv_frame() but not consumed yet
+
+    def feed(self, data):
+        """Add received bytes and return the list of frames they completed."""
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        size = len(buffer)
+        while size - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes is larger than {self.max_frame_size} bytes.")
+            end = offset + HEADER.size + length
+            if end > size:
+                break  # The rest of this frame has not arrived yet
+            frames.append(bytes(buffer[offset + HEADER.size:end]))
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+
+def recv_frame(sock, decoder):
+    """Block until one frame is available on a blocking socket and return it, or None if the peer closed."""
+    while not decoder.backlog:
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        decoder.backlog.extend(decoder.feed(data))
+    return decoder.backlog.popleft()
@@ -1,10 +1,33 @@
 # Import necessary libraries
 import socket
-import select
+import selectors
 import os
-from collections import defaultdict
+from collections import Counter, deque
+from chat_killer_protocol import HEADER, HEARTBEAT, MAX_FRAME_SIZE, MAX_MESSAGE_SIZE, FrameDecoder, FrameError, RECV_SIZE, encode_frame, encode_frame_parts
+from itertools import islice
 import logging
+import logging.handlers
+import queue
 import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import signal
+import enum
+import ssl
+from chat_killer_broker import MAX_ENVELOPE_SIZE, connect_to_broker, create_broker_socket, decode_envelope, encode_envelope, run_broker
+from chat_killer_metrics import COUNT_BUCKETS, encode_snapshot, format_report, increment, observe
+from chat_killer_journal import FSYNC_POLICIES, Journal
+from chat_killer_timers import TimerWheel
+try:
+    import resource  # Only available on Unix, used to raise the open-files limit
+except ImportError:
+    resource = None
+try:
+    import uvloop  # Optional faster event loop for the --async engine
+except ImportError:
+    uvloop = None
 
 
 #--------------------------------------------------------------------------------------------############################
@@ -13,126 +36,708 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 #--------------------------------------------------------------------------------------------#                          #
 # Server configuration variables                                                             #                          #
 SERVER_IP = '127.0.0.1'  # Listen on all network interfaces                                  #                          #
-# Check for command-line arguments for the port number                                       #            ^             #             
-if len(sys.argv) != 2:                                                                       #          ^   ^           #                         
-    print("Usage: python3 server.py <port_number>")                                          #        ^   ^  ^          #        
-    sys.exit()                                                                               #                          #                                                             
-SERVER_PORT = int(sys.argv[1])  # Use the port number provided from command-line arguments   #    -                -    #                             
-MAX_CONNECTIONS = 10  # Maximum number of simultaneous client connections                    #    |----------------|    #
+# Runtime settings, filled in from the command-line arguments by main()                      #            ^             #             
+server_socket = None  # Listening socket of the synchronous engine, created in main()        #          ^   ^           #
+async_mode = False  # Set by --async, the asyncio engine then owns the connections           #        ^   ^  ^          #
+LISTEN_BACKLOG = socket.SOMAXCONN  # Accept backlog, bounded by the kernel's own limit       #                          #
+SERVER_PORT = None  # Use the port number provided from command-line arguments, see main()   #    -                -    #
+MAX_CONNECTIONS = 10000  # Maximum number of simultaneous client connections                 #    |----------------|    #
 MODERATOR_USERNAME = "Admin"                                                                 #    -                -    #
+DEFAULT_ROOM = "lobby"  # Room every player joins after logging in, moderated by the Admin
+ADMIN_PASSWORD = "admin123"
+MAX_USERNAME_SIZE = 256  # Longest USERNAME in bytes, its relayed prefix must fit in the room MAX_MESSAGE_SIZE leaves in a frame
+HANDSHAKE_TIMEOUT = 30  # Set by --handshake-timeout: seconds a new connection has to complete the TLS and login exchange
+HEARTBEAT_INTERVAL = 30  # Set by --heartbeat: seconds of silence after which a client is pinged, 0 to never ping
+IDLE_TIMEOUT = 90  # Set by --idle-timeout: seconds of silence, pongs included, after which a client is closed, 0 to never close
+ACCEPT_BATCH = 64  # Maximum number of connections accepted per wakeup of the listening socket
+OUTBOX_HIGH_WATER = 1024 * 1024  # Set by --outbox-high-water: bytes a client may have queued before it is treated as a slow consumer
+HISTORY_SIZE = 50  # Recent chat messages kept per room and sent to every player who joins it, 0 to disable
+SLOW_CONSUMER_POLICY = 'disconnect'  # Set by --slow-consumer: 'disconnect' closes slow consumers, 'drop' discards the messages they cannot take
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')  # Most buffers a single sendmsg() call may gather
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+STATS_PORT = None  # Set by --stats-port: local port answering every connection with a JSON metrics snapshot
+LOG_LEVEL = logging.DEBUG  # Level set by --log-level; SIGUSR2 switches between it and DEBUG at runtime
+LOG_QUEUE = False  # Set by --log-queue: log records are formatted and written by a background thread
+DEBUG_SAMPLE_RATE = 1  # Set by --debug-sample N: write one per-message debug line out of N
+JOURNAL_DIR = None  # Set by --journal DIR: directory of the append-only journal that survives restarts
+JOURNAL_FSYNC = 'interval'  # Set by --fsync: 'always', 'interval' or 'never'
+JOURNAL_FLUSH_INTERVAL = 0.05  # Seconds between journal batches in the asyncio engine
+JOURNALED_KINDS = {'join', 'leave', 'state', 'room', 'ban'}  # Published changes a restart must restore
+RATE_LIMIT = 20  # Set by --rate-limit: messages per second a player may send on average, 0 disables flood control
+RATE_BURST = 40  # Set by --rate-burst: messages a player may send at once after being quiet
+COMMAND_RATES = {'pm': (10, 20), 'list': (2, 5), 'rooms': (2, 5), 'join': (1, 3)}  # Label -> (per second, burst)
+FLOOD_WINDOW = 10  # Seconds without a dropped message after which a player's strikes are forgotten
+FLOOD_SUSPEND_STRIKES = 20  # Set by --flood-suspend: dropped messages that suspend a player, 0 to never suspend
+FLOOD_BAN_STRIKES = 100  # Set by --flood-ban: dropped messages that ban a player, 0 to never ban
+TLS_WRITE_SIZE = 256 * 1024  # Most queued bytes encrypted by one write on a TLS connection
 #-----------------------------------------------------------------------------------------------------------------------#
 # Client management variables                                                                                           
-clients = {}  # Dictionary to store client socket objects along with additional information                             
-client_states = defaultdict(lambda: "active")  # Tracks the current state ('active', 'suspended', etc.) of each client  
-game_active = False # Flag to indicate if the game has started                                                          
+clients = {}  # Connected players: socket -> Session
+rooms = {}  # Room name -> {'name', 'members': {socket: Session}, 'moderator', 'game_active', 'history' ring buffer}
+usernames = {}  # USERNAME -> socket index kept alongside clients, so lookups by name are O(1)
+moderator_socket = None  # Socket of the logged in Admin, None while the Admin is away
+pending = {}  # Connections still in the login exchange, keyed by socket ('stage' is 'tls', 'username' or 'password')
+dirty_clients = set()  # Sockets with queued output that have not been flushed in this loop iteration
+outbox_stats = {'dropped_frames': 0, 'slow_consumers_disconnected': 0, 'peak_outbox_bytes': 0}
+timers = TimerWheel(time.monotonic())  # One timer per connection: its login deadline, then its next liveness check
+banned_usernames = set()  # USERNAMEs refused at login, kept across restarts by the journal
+journal = None  # Journal opened by main() when --journal is given
+tls_context = None  # Server SSLContext created by main() when --tls-cert is given, shared by forked workers
 #-----------------------------------------------------------------------------------------------------------------------#
-# Socket setup                                                                                                          
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)                                                       
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)                                                     
-server_socket.bind((SERVER_IP, SERVER_PORT))                                                                            
-server_socket.listen(MAX_CONNECTIONS)                                                                                   
+# Event engine                                                                                                          
+selector = None  # epoll/kqueue backed event engine, created by start_server() so forked workers never share it         
+stats_socket = None  # Listening socket of the --stats-port endpoint in the selectors engine
+log_listener = None  # QueueListener writing the log records on its own thread when LOG_QUEUE is set
+debug_skipped = 0  # Per-message debug lines skipped since the last one written
 #-----------------------------------------------------------------------------------------------------------------------#
-logging.info(f"Server started on {SERVER_IP} : {SERVER_PORT}.")                                                         
+# Multi-process mode (--workers N)                                                                                      
+worker_id = None  # Number of this worker process, None when the server runs as a single process                        
+broker_link = None  # Unix-domain connection to the broker that links the workers                                       
+broker_decoder = FrameDecoder(MAX_ENVELOPE_SIZE)
+remote_users = {}  # Players hosted by the other workers: USERNAME -> {'state', 'room'}, mirrored from the broker       
+remote_room_sizes = Counter()  # Room name -> number of players in it hosted by the other workers                       
 #-----------------------------------------------------------------------------------------------------------------------#
 
    
+#-------------------------------------------------#
+# Logging
+# The handlers of basicConfig above stay the final destination; with --log-queue the event loop only
+# appends records to a queue and a QueueListener thread formats and writes them.
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are, so the message is formatted by the listener thread rather than the loop."""
+
+    def prepare(self, record):
+        return record  # The listener runs in this process, nothing needs to be pickled
+
+def start_log_queue():
+    """Move the root handlers behind a queue served by a background thread; called in each process that serves."""
+    global log_listener
+    if not LOG_QUEUE or log_listener is not None:
+        return
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    records = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+    log_listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    log_listener.start()
+
+def stop_log_queue():
+    """Write the queued records and stop the listener thread; needed before os._exit()."""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+def toggle_debug_logging(signum=None, frame=None):
+    """Switch between DEBUG and the configured level; installed as the SIGUSR2 handler."""
+    root = logging.getLogger()
+    level = logging.INFO if LOG_LEVEL == logging.DEBUG else LOG_LEVEL
+    root.setLevel(level if root.level == logging.DEBUG else logging.DEBUG)
+    logging.warning("Log level set to %s.", logging.getLevelName(root.level))
+
+def install_logging_signal():
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, toggle_debug_logging)
+
+def sample_debug():
+    """Tell whether to write the debug line of one message: DEBUG is on and the sampling picks this one."""
+    global debug_skipped
+    if not logging.root.isEnabledFor(logging.DEBUG):
+        return False
+    debug_skipped += 1
+    if debug_skipped < DEBUG_SAMPLE_RATE:
+        return False
+    debug_skipped = 0
+    return True
+
+
+#-------------------------------------------------#
+# Sessions
+
+class State(enum.Enum):
+    """State of a player in their room; the value is what the broker and the journal carry."""
+    ACTIVE = 'active'
+    SUSPENDED = 'suspended'
+
+
+class Session:
+    """Everything the server keeps about one connection, from accept() until it is closed.
+
+    The Session lives in pending during the login, then in clients and in the members of its room; closing
+    the connection removes it from all of them at once, so nothing about a player outlives the socket.
+    """
+
+    __slots__ = ('address', 'stage', 'USERNAME', 'decoder', 'outbox', 'outbox_bytes', 'writing', 'overflowed',
+                 'deadline', 'wakeup', 'prefix', 'room', 'state', 'bucket', 'command_buckets', 'strikes', 'strike_time',
+                 'last_seen')
+
+    def __init__(self, address):
+        self.address = address
+        self.stage = 'username'  # ['tls' ->] 'username' -> 'password' (Admin only) -> 'joined'
+        self.USERNAME = None
+        self.decoder = FrameDecoder(MAX_MESSAGE_SIZE)  # Leaves room for what the server adds when it relays
+        self.outbox = deque()  # Encoded frames waiting for the socket to be writable
+        self.outbox_bytes = 0
+        self.writing = False  # Whether the selector watches the socket for writability
+        self.overflowed = False  # Set when the outbox went over OUTBOX_HIGH_WATER, closed after this iteration
+        self.deadline = None  # Monotonic time by which the login must be complete
+        self.wakeup = None  # asyncio.Event waking the connection's writer task in the asyncio engine
+        self.prefix = b''  # Encoded "USERNAME: " put in front of the player's chat messages
+        self.room = None
+        self.state = State.ACTIVE
+        self.bucket = None  # TokenBucket of all the player's messages, created with the first one
+        self.command_buckets = None  # Command label -> TokenBucket, for the labels of COMMAND_RATES
+        self.strikes = 0  # Messages dropped by flood control since the last FLOOD_WINDOW of calm
+        self.strike_time = 0.0
+        self.last_seen = None  # Monotonic time of the last bytes received, a pong included
+
+
 #-------------------------------------------------#
 # Helper functions
 
 def get_client_by_USERNAME(USERNAME):
     """Retrieve client socket based on USERNAME."""
-    for client, details in clients.items():
-        if details['USERNAME'] == USERNAME:
-            return client
-    return None
+    return usernames.get(USERNAME)
+
+def raise_open_files_limit():
+    """Raise the soft limit on open file descriptors so thousands of players can connect."""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = MAX_CONNECTIONS + 64  # Keep some room for the server socket and log files
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            logging.info(f"Raised open files limit from {soft} to {wanted}.")
+    except (ValueError, OSError) as e:
+        logging.error(f"Could not raise open files limit: {str(e)}")
+
+def create_server_socket():
+    """Create the non-blocking listening socket of the synchronous engine."""
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if worker_id is not None:
+        # Every worker binds the same port, the kernel spreads new connections between them
+        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listening_socket.bind((SERVER_IP, SERVER_PORT))
+    listening_socket.setblocking(False)  # accept() must never stall the event loop
+    listening_socket.listen(LISTEN_BACKLOG)
+    return listening_socket
+
+def register_client(client_socket, session, room):
+    """Move a connection that completed the login exchange into the clients registry, the USERNAME index and a room."""
+    global moderator_socket
+    pending.pop(client_socket, None)
+    increment('handshakes_completed')
+    observe('handshake_seconds', time.monotonic() - (session.deadline - HANDSHAKE_TIMEOUT))
+    session.prefix = f"{session.USERNAME}: ".encode('utf-8')  # Encoded once, reused by every broadcast
+    session.room = None
+    clients[client_socket] = session
+    schedule_liveness_check(client_socket, session)  # Replaces the login deadline
+    usernames[session.USERNAME] = client_socket
+    if session.USERNAME == MODERATOR_USERNAME:
+        moderator_socket = client_socket
+    if room is not None:
+        add_to_room(client_socket, room)
+        send_room_history(client_socket, room)
+    publish('join', USERNAME=session.USERNAME, state=session.state.value, room=room and room['name'])
+
+def publish(kind, body=b'', **fields):
+    """Send an envelope to the broker so the other workers see this change, and write it to the journal."""
+    if journal is not None:
+        if kind == 'broadcast':
+            journal.append('message', room=fields['room'], text=body[HEADER.size:].decode('utf-8', errors='replace'))
+        elif kind in JOURNALED_KINDS:
+            journal.append(kind, **fields)
+    if broker_link is not None:
+        try:
+            broker_link.sendall(encode_envelope(kind, body, **fields))
+        except OSError as e:
+            logging.error(f"Failed to publish {kind} to the broker: {str(e)}")
+
+def USERNAME_in_use(USERNAME):
+    """Tell whether a player with this USERNAME is connected to this worker or any other."""
+    return USERNAME in usernames or USERNAME in remote_users
 
 def close_client_connection(client_socket):
+    """Stop watching a client socket, drop its Session from every registry and close it."""
+    global moderator_socket
+    session = clients.pop(client_socket, None)
+    pending.pop(client_socket, None)
+    dirty_clients.discard(client_socket)
+    timers.cancel(client_socket)
+    if session is not None:
+        # The room, the USERNAME index and clients are the only places holding the Session
+        remove_from_room(client_socket, session)
+        if usernames.get(session.USERNAME) is client_socket:
+            del usernames[session.USERNAME]
+            publish('leave', USERNAME=session.USERNAME)
+    if client_socket is moderator_socket:
+        moderator_socket = None
+    if not async_mode:
+        try:
+            selector.unregister(client_socket)
+        except (KeyError, ValueError):
+            pass  # The socket was never registered or is already closed
     try:
         client_socket.close()
-        clients.pop(client_socket, None)
-        logging.info(f"Closed connection from {clients[client_socket]['address'][0]}.")
+        if session is not None:
+            logging.info("Closed connection from %s.", session.address[0])
     except Exception as e:
         logging.error("Error closing client connection: " + str(e))
 
+#-------------------------------------------------#
+# Room functions
+# A room has its own roster (members: socket -> Session), moderator and started flag, so broadcasts only
+# cost the size of the room and one process can host many games side by side.
+
+def new_room(name, moderator):
+    """Return the record of an empty room."""
+    return {'name': name, 'members': {}, 'moderator': moderator, 'game_active': False,
+            'history': [None] * HISTORY_SIZE, 'history_next': 0}  # Ring buffer of encoded chat frames
+
+def remember_message(room, frame):
+    """Keep an encoded chat frame in the room's ring buffer in place of the oldest one; memory stays bounded."""
+    if HISTORY_SIZE:
+        room['history'][room['history_next']] = frame
+        room['history_next'] = (room['history_next'] + 1) % HISTORY_SIZE
+
+def send_room_history(client_socket, room):
+    """Queue the recent messages of a room, oldest first, as one write to a player who just joined it."""
+    history = room['history']
+    start = room['history_next']
+    frames = []
+    budget = OUTBOX_HIGH_WATER // 2  # Never make the catch-up itself look like a slow consumer
+    for frame in reversed(history[start:] + history[:start]):
+        if frame is None or len(frame) > budget:
+            break
+        frames.append(frame)
+        budget -= len(frame)
+    if frames:
+        frames.reverse()
+        queue_frame(client_socket, b''.join(frames))
+
+def add_to_room(client_socket, room):
+    """Put a registered client into a room with a fresh active state."""
+    session = clients[client_socket]
+    room['members'][client_socket] = session
+    session.room = room
+    session.state = State.ACTIVE
+
+def remove_from_room(client_socket, session):
+    """Take a client out of its room, dropping the room once nobody is left in it."""
+    room = session.room
+    if room is None:
+        return
+    room['members'].pop(client_socket, None)
+    session.room = None
+    discard_room_if_empty(room['name'])
+
+def discard_room_if_empty(name):
+    """Forget a room that has no players on any worker; the default room always stays."""
+    room = rooms.get(name)
+    if room is not None and name != DEFAULT_ROOM and not room['members'] and not remote_room_sizes[name]:
+        del rooms[name]
+        remote_room_sizes.pop(name, None)
+        if journal is not None:
+            journal.append('discard', room=name)
+
+def set_state(client_socket, state):
+    """Change the State of a client in its current room and tell the other workers."""
+    session = clients[client_socket]
+    session.state = state
+    publish('state', USERNAME=session.USERNAME, state=state.value, room=session.room['name'])
+
+def is_room_moderator(client_socket, room):
+    """Tell whether a client may moderate a room: the Admin everywhere, otherwise the room's own moderator."""
+    if client_socket is moderator_socket:
+        return True
+    return room is not None and room['moderator'] == clients[client_socket].USERNAME
+
+def room_roster(room):
+    """Return (USERNAME, state) pairs of everybody in a room, on this worker and the others."""
+    roster = [(session.USERNAME, session.state.value) for session in room['members'].values()]
+    if remote_room_sizes[room['name']]:
+        roster.extend((USERNAME, entry['state']) for USERNAME, entry in remote_users.items()
+                      if entry['room'] == room['name'])
+    return roster
+
+def set_remote_user(USERNAME, state, room_name):
+    """Record where a player hosted by another worker is and in which state."""
+    drop_remote_user(USERNAME, keep_room=room_name)
+    remote_users[USERNAME] = {'state': state, 'room': room_name}
+    if room_name is not None:
+        remote_room_sizes[room_name] += 1
+
+def drop_remote_user(USERNAME, keep_room=None):
+    """Forget a player hosted by another worker."""
+    entry = remote_users.pop(USERNAME, None)
+    if entry is not None and entry['room'] is not None:
+        remote_room_sizes[entry['room']] -= 1
+        if entry['room'] != keep_room:
+            discard_room_if_empty(entry['room'])
+
+rooms[DEFAULT_ROOM] = new_room(DEFAULT_ROOM, MODERATOR_USERNAME)
+
+
+#-------------------------------------------------#
+# Journal (see chat_killer_journal.py)
+
+def open_journal():
+    """Open the journal and bring back the rooms and bans it recorded; players get their room back on login."""
+    global journal
+    started = time.monotonic()
+    journal = Journal(JOURNAL_DIR, JOURNAL_FSYNC)
+    for name, saved in journal.state['rooms'].items():
+        room = rooms.get(name)
+        if room is None:
+            room = rooms[name] = new_room(name, saved['moderator'])
+        room['moderator'] = saved['moderator']
+        room['game_active'] = saved['game_active']
+    banned_usernames.update(journal.state['banned'])
+    logging.info("Journal %s replayed %s records in %.3f s: %s rooms, %s players to restore, %s banned.", JOURNAL_DIR,
+                 journal.replayed, time.monotonic() - started, len(journal.state['rooms']),
+                 len(journal.state['players']), len(banned_usernames))
+
+def flush_journal():
+    """Write the records of this loop iteration in one batch."""
+    if journal is not None:
+        try:
+            journal.flush()
+        except OSError as e:
+            logging.error(f"Failed to write the journal: {str(e)}")
+
+def close_journal():
+    """Snapshot and close the journal; players disconnected after this are not recorded as leaving."""
+    global journal
+    if journal is not None:
+        closing, journal = journal, None
+        try:
+            closing.close()
+        except OSError as e:
+            logging.error(f"Failed to close the journal: {str(e)}")
+
+async def journal_flusher():
+    """Batch the journal writes of the asyncio engine."""
+    while True:
+        await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
+        flush_journal()
+
+
+def queue_frame(client_socket, frame):
+    """Append an encoded frame to the client's outbound queue; it is written when the socket is writable."""
+    session = clients.get(client_socket) or pending.get(client_socket)
+    if session is None or session.overflowed:
+        return False
+    queued = session.outbox_bytes + len(frame)
+    if queued > OUTBOX_HIGH_WATER:
+        # Slow consumer: never let one client's full TCP window hold up everybody else
+        if SLOW_CONSUMER_POLICY == 'drop':
+            outbox_stats['dropped_frames'] += 1
+            return False
+        session.overflowed = True  # Closed after this loop iteration, we may be iterating over clients
+        outbox_stats['slow_consumers_disconnected'] += 1
+        logging.info(f"Disconnecting slow consumer {session.USERNAME} with {session.outbox_bytes} bytes queued.")
+        if async_mode:
+            session.wakeup.set()
+        else:
+            dirty_clients.add(client_socket)
+        return False
+    session.outbox.append(frame)
+    session.outbox_bytes = queued
+    increment('messages_out')
+    if queued > outbox_stats['peak_outbox_bytes']:
+        outbox_stats['peak_outbox_bytes'] = queued
+    if async_mode:
+        session.wakeup.set()  # Hand the queue to the connection's writer task
+    else:
+        dirty_clients.add(client_socket)
+    return True
+
+def send_to_client(client_socket, message):
+    """Queue one message (str or bytes) for a client as a single protocol frame."""
+    try:
+        frame = encode_frame(message)
+    except ValueError as e:
+        # The server's own reply is too large: drop it, the client did nothing wrong (listings use send_listing())
+        logging.warning("Reply not sent: %s", e)
+        return False
+    return queue_frame(client_socket, frame)
+
+def send_listing(client_socket, rows):
+    """Send the lines of a listing packed into as few frames as fit them, so a long listing is split, not dropped."""
+    block = []
+    size = -1  # The first line of a frame has no newline before it
+    for row in rows:
+        row_size = len(row.encode('utf-8')) + 1
+        if block and size + row_size > MAX_FRAME_SIZE:
+            send_to_client(client_socket, "\n".join(block))
+            block = []
+            size = -1
+        block.append(row)
+        size += row_size
+    send_to_client(client_socket, "\n".join(block))
+
+def flush_outbox(client_socket):
+    """Write as much queued output as the socket accepts without blocking; return True once the queue is empty."""
+    session = clients.get(client_socket) or pending.get(client_socket)
+    outbox = session.outbox
+    tls = isinstance(client_socket, ssl.SSLSocket)
+    while outbox:
+        if tls:
+            # SSLSocket has no sendmsg(); join the frames into one write instead. A write that raises
+            # SSLWantWriteError must be retried with the same bytes, which the same front of the queue gives.
+            batch = tls_write_batch(outbox)
+        else:
+            # Gather every pending frame into one system call instead of one send() per message
+            batch = list(islice(outbox, IOV_MAX))
+        try:
+            if tls:
+                sent = client_socket.send(b''.join(batch))
+            else:
+                sent = client_socket.sendmsg(batch)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            return False
+        session.outbox_bytes -= sent
+        increment('bytes_out', sent)
+        observe('frames_per_send', len(batch), COUNT_BUCKETS)
+        while sent:
+            frame = outbox[0]
+            if sent < len(frame):
+                outbox[0] = memoryview(frame)[sent:]  # Keep the unsent tail without copying it
+                return False
+            sent -= len(frame)
+            outbox.popleft()
+        if tls or len(batch) == IOV_MAX:
+            continue  # More frames are waiting behind this batch
+        if outbox:
+            return False  # The kernel took less than the whole batch
+    return True
+
+def tls_write_batch(outbox):
+    """Return the frames at the front of a TLS connection's queue, up to about TLS_WRITE_SIZE bytes."""
+    batch = []
+    size = 0
+    for frame in outbox:
+        batch.append(frame)
+        size += len(frame)
+        if size >= TLS_WRITE_SIZE:
+            break
+    return batch
+
+def update_write_interest(client_socket):
+    """Watch a socket for writability only while it has queued output."""
+    session = clients.get(client_socket) or pending.get(client_socket)
+    wanted = bool(session.outbox)
+    if wanted != session.writing:
+        session.writing = wanted
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if wanted else selectors.EVENT_READ
+        selector.modify(client_socket, events)
+
+def handle_writable(client_socket):
+    """Flush a client's queue when the socket reports it can take more data."""
+    session = clients.get(client_socket) or pending.get(client_socket)
+    if session.stage == 'tls':
+        continue_tls_handshake(client_socket, session)
+        return
+    try:
+        flush_outbox(client_socket)
+        update_write_interest(client_socket)
+    except socket.error as e:
+        increment('send_failures')
+        logging.error(f"Failed to send message to {(clients.get(client_socket) or pending[client_socket]).address[0]}: {str(e)}.")
+        close_client_connection(client_socket)
+
+def flush_dirty_clients():
+    """Try to write the output queued during this loop iteration, closing slow consumers."""
+    while dirty_clients:
+        client_socket = dirty_clients.pop()
+        session = clients.get(client_socket) or pending.get(client_socket)
+        if session is None:
+            continue
+        if session.overflowed:
+            close_client_connection(client_socket)
+        else:
+            handle_writable(client_socket)
+
+def close_after_flush(client_socket):
+    """Write what is still queued for a client as far as the socket allows, then close it."""
+    session = clients.get(client_socket) or pending.get(client_socket)
+    if session is None:
+        return
+    try:
+        if async_mode:
+            # The transport keeps writing its buffer after close(), the writer task is not needed for this
+            client_socket.writelines(session.outbox)
+            session.outbox.clear()
+        else:
+            flush_outbox(client_socket)
+    except (socket.error, RuntimeError):
+        pass  # The peer is already gone, nothing more to tell it
+    close_client_connection(client_socket)
+
+def refuse_connection(client_socket, message):
+    """Send a last message to a connection that failed the login exchange and close it."""
+    increment('connections_refused')
+    session = pending.get(client_socket)
+    if session is not None and session.stage == 'tls':
+        close_client_connection(client_socket)  # Nothing can be sent before the TLS handshake is complete
+        return
+    send_to_client(client_socket, message)
+    close_after_flush(client_socket)
+
+def queue_metrics():
+    """Return a summary of the outbound queues: depths in bytes plus drop/disconnect counters."""
+    depths = [session.outbox_bytes for session in clients.values()]
+    metrics = dict(outbox_stats)
+    metrics.update({'queued_bytes': sum(depths), 'max_queue_bytes': max(depths, default=0),
+                    'clients_with_backlog': sum(1 for depth in depths if depth)})
+    return metrics
+
+
+#-------------------------------------------------#
+# Metrics (see chat_killer_metrics.py)
+
+def metrics_gauges():
+    """Return the current sizes of the registries and queues, reported next to the counters."""
+    gauges = queue_metrics()
+    gauges.update({'clients': len(clients), 'pending': len(pending), 'rooms': len(rooms),
+                   'remote_users': len(remote_users)})
+    if worker_id is not None:
+        gauges['worker'] = worker_id
+    return gauges
+
+def dump_metrics(signum=None, frame=None):
+    """Write every metric to the log; installed as the SIGUSR1 handler."""
+    logging.info(format_report(metrics_gauges()))
+
+def install_metrics_signal():
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, dump_metrics)
+
+def create_stats_socket():
+    """Bind the --stats-port endpoint; worker N of --workers listens on STATS_PORT + N."""
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind((SERVER_IP, STATS_PORT + (worker_id or 0)))
+    listening_socket.setblocking(False)
+    listening_socket.listen(16)
+    return listening_socket
+
+def answer_stats_request():
+    """Send a JSON snapshot to a connection on the stats port and close it."""
+    try:
+        stats_client, _ = stats_socket.accept()
+    except (BlockingIOError, InterruptedError):
+        return
+    try:
+        stats_client.settimeout(1)  # A few kilobytes on a local socket, never a real wait
+        stats_client.sendall(encode_snapshot(metrics_gauges()))
+    except OSError:
+        pass
+    finally:
+        stats_client.close()
+
+
 
 #-------------------------------------------------#
 # Command handling functions
 
-def handle_start_game():
-    """Handle the !start command to begin the game."""
-    global game_active
-    logging.info("Received a request to start the game.")
-    if game_active == False:
-        game_active = True
-        broadcast_message_to_all("Game has started. No new players can join.")
-        logging.info("Game started!")
+def handle_start_game(client_socket):
+    """Handle the !start command to begin the game of the sender's room."""
+    room = clients[client_socket].room
+    if room is None:
+        send_to_client(client_socket, "You are not in a room. Use !rooms and !join <room>.")
+        return
+    logging.info(f"Received a request to start the game in {room['name']}.")
+    if room['game_active'] == False:
+        room['game_active'] = True
+        publish('room', room=room['name'], moderator=room['moderator'], game_active=True)
+        broadcast_message_to_all("Game has started. No new players can join.", room=room)
+        logging.info(f"Game started in {room['name']}!")
     else:
-        broadcast_message_to_all("Game has already started.")
+        broadcast_message_to_all("Game has already started.", room=room)
         logging.info("Attempt to start an already active game.")
 
 def handle_ban(target_client):
     """Ban a player specified by the client socket."""
     if target_client in clients:
-        if target_client == get_client_by_USERNAME(MODERATOR_USERNAME):
+        if target_client is moderator_socket:
             logging.info("Admin cannot ban themselves.")
             return
-        target_client.send("You have been banned from the game.".encode('utf-8'))
-        ban_message = f"Player {clients[target_client]['USERNAME']} has been banned"
+        send_to_client(target_client, "You have been banned from the game.")
+        banned_usernames.add(clients[target_client].USERNAME)
+        publish('ban', USERNAME=clients[target_client].USERNAME)
+        ban_message = f"Player {clients[target_client].USERNAME} has been banned"
         broadcast_message(target_client, ban_message.encode('utf-8'))
         logging.info(f"{ban_message} by Admin")
-        target_client.close()
-        clients.pop(target_client, None)
+        close_after_flush(target_client)
     else:
         logging.error("Attempted to ban a non-existent client.")
 
 def handle_suspend(client_socket):
     if client_socket in clients:
         # Check if the target is the moderator or if the client is already suspended
-        if client_socket == get_client_by_USERNAME(MODERATOR_USERNAME):
-            #client_socket.send("Admin cannot be suspended.".encode('utf-8'))
+        if client_socket is moderator_socket:
+            #send_to_client(client_socket, "Admin cannot be suspended.")
             logging.info("Attempt to suspend the admin was blocked.")
             return
+        room = clients[client_socket].room
+        if room is None:
+            logging.info(f"Attempt to suspend {clients[client_socket].USERNAME} who is in no room was blocked.")
+            return
 
-        if client_states[client_socket] == 'suspended':
-            client_socket.send(f"Admin tried to suspend you again.".encode('utf-8'))
-            broadcast_message_to_all(f"{clients[client_socket]['USERNAME']} is already suspended.", client_socket)
-            logging.info(f"Attempt to re-suspend {clients[client_socket]['USERNAME']} was blocked.")
+        if clients[client_socket].state is State.SUSPENDED:
+            send_to_client(client_socket, f"Admin tried to suspend you again.")
+            broadcast_message_to_all(f"{clients[client_socket].USERNAME} is already suspended.", client_socket, room=room)
+            logging.info(f"Attempt to re-suspend {clients[client_socket].USERNAME} was blocked.")
             return
 
         try:
-            clients[client_socket]['state'] = 'suspended'
-            client_states[client_socket] = 'suspended'  # Update the state in the dictionary
-            client_socket.send("You have been suspended.".encode('utf-8'))
-            broadcast_message_to_all(f"{clients[client_socket]['USERNAME']} has been suspended.", client_socket)
-            logging.info(f"{clients[client_socket]['USERNAME']} has been suspended.")
+            set_state(client_socket, State.SUSPENDED)  # Update the state of the player's Session
+            send_to_client(client_socket, "You have been suspended.")
+            broadcast_message_to_all(f"{clients[client_socket].USERNAME} has been suspended.", client_socket, room=room)
+            logging.info(f"{clients[client_socket].USERNAME} has been suspended.")
         except Exception as e:
-            logging.error(f"Failed to suspend {clients[client_socket]['USERNAME']}: {str(e)}")
+            logging.error(f"Failed to suspend {clients[client_socket].USERNAME}: {str(e)}")
 
 def handle_forgive(client_socket):
     if client_socket in clients:
-        if client_socket == get_client_by_USERNAME(MODERATOR_USERNAME):
+        if client_socket is moderator_socket:
             logging.info("Admin cannot forgive themselves.")
             return
-        if client_states[client_socket] == 'active':
-            broadcast_message_to_all(f"{clients[client_socket]['USERNAME']} is not suspended to be forgiven.")
-            logging.info(f"Attempt to forgive {clients[client_socket]['USERNAME']} which is not suspended was blocked.")
+        room = clients[client_socket].room
+        if room is None:
+            logging.info(f"Attempt to forgive {clients[client_socket].USERNAME} who is in no room was blocked.")
+            return
+        if clients[client_socket].state is State.ACTIVE:
+            broadcast_message_to_all(f"{clients[client_socket].USERNAME} is not suspended to be forgiven.", room=room)
+            logging.info(f"Attempt to forgive {clients[client_socket].USERNAME} which is not suspended was blocked.")
             return
         try:
-            clients[client_socket]['state'] = 'active'
-            client_states[client_socket] = 'active'  # Update the state back to active
-            client_socket.send("You have been forgiven and can participate again.".encode('utf-8'))
-            broadcast_message_to_all(f"{clients[client_socket]['USERNAME']} has been forgiven.", client_socket)
-            logging.info(f"{clients[client_socket]['USERNAME']} has been forgiven.")
+            set_state(client_socket, State.ACTIVE)  # Update the state back to active
+            send_to_client(client_socket, "You have been forgiven and can participate again.")
+            broadcast_message_to_all(f"{clients[client_socket].USERNAME} has been forgiven.", client_socket, room=room)
+            logging.info(f"{clients[client_socket].USERNAME} has been forgiven.")
         except Exception as e:
             logging.error("Failed to lift suspension: " + str(e))
-            
+
 def handle_PM(message, recipients, sender_USERNAME, client_socket):
     # Handling private message to one or more users including Moderator
         if len(message) == 0:
-            client_socket.send("You didn't enter a message.".encode('utf-8'))
+            send_to_client(client_socket, "You didn't enter a message.")
             return
 
-        final_message = f"PM from {sender_USERNAME}: {' '.join(message)}"
+        final_message = encode_frame(f"PM from {sender_USERNAME}: {message}")
+        if journal is not None:
+            journal.append('pm', USERNAME=sender_USERNAME, recipients=recipients, text=message)
         # Send message to all recipients and Moderator (if not already included)
         if sender_USERNAME != MODERATOR_USERNAME:
             recipients.append(MODERATOR_USERNAME)  # Ensure moderator gets the PM
@@ -140,149 +745,319 @@ def handle_PM(message, recipients, sender_USERNAME, client_socket):
         for recipient in recipients:
             target_client = get_client_by_USERNAME(recipient)
             if target_client:
-                target_client.send(final_message.encode('utf-8'))
+                queue_frame(target_client, final_message)
+            elif recipient in remote_users:
+                publish('deliver', final_message, USERNAME=recipient)  # Routed to the worker hosting the recipient
             elif recipient != MODERATOR_USERNAME:
-                client_socket.send(f"No such user: {recipient}".encode('utf-8'))
+                send_to_client(client_socket, f"No such user: {recipient}")
             #else:
-            #   client_socket.send(f"No such user: {recipient}".encode('utf-8'))
+            #   send_to_client(client_socket, f"No such user: {recipient}")
 
 def handle_logout(client_socket):
     """Handle the logout command."""
-    logging.info(f"Client {clients[client_socket]['USERNAME']} has disconnected.")
-    client_socket.send(f"Goodbye {clients[client_socket]['USERNAME']}!".encode('utf-8'))
-    broadcast_message_to_all(f"{clients[client_socket]['USERNAME']} has left the chat.", client_socket)
-    client_socket.close()
-    clients.pop(client_socket, None)
+    logging.info("Client %s has disconnected.", clients[client_socket].USERNAME)
+    send_to_client(client_socket, f"Goodbye {clients[client_socket].USERNAME}!")
+    broadcast_message_to_all(f"{clients[client_socket].USERNAME} has left the chat.", client_socket,
+                             room=clients[client_socket].room)
+    close_after_flush(client_socket)
 
-def handle_shutodwn():
+def handle_shutodwn(notify_workers=True):
+    global broker_link
     logging.info("Server is shutting down on admin command.")
+    if notify_workers:
+        publish('shutdown')
+    broker_link = None  # The whole cluster is stopping, the players leaving need not be published
+    close_journal()  # Before the players are closed: they are expected back after the restart
     for client_socket in list(clients.keys()):
         try:
-            client_socket.send("Server is shutting down.".encode('utf-8'))
-            client_socket.close()
+            send_to_client(client_socket, "Server is shutting down.")
+            close_after_flush(client_socket)
         except socket.error as e:
             logging.error(f"Error closing client socket: {e}")
-    global server_socket
-    server_socket.close()
+    if server_socket is not None:
+        server_socket.close()
+    stop_log_queue()  # os._exit() skips the listener thread, write what it still holds
     os._exit(0)  # Forcefully stop the program
 
 def handle_list_command(requesting_client_socket):
     """
-    Handle the !list command to display the status of all clients in a tabular format.
+    Handle the !list command to display the status of the clients of the requester's room in a tabular format.
     Send the list back to the client who requested it.
     """
+    room = clients[requesting_client_socket].room
+    if room is None:
+        send_to_client(requesting_client_socket, "You are not in a room. Use !rooms and !join <room>.")
+        return
     header = f"{'USERNAME':<20} | {'State':<10}\n" + "-" * 32
     status_message = [header]
 
-    sorted_clients = sorted(clients.items(), key=lambda item: item[1]['USERNAME'])
-
-    for client_socket, details in sorted_clients:
-        USERNAME = details['USERNAME']
-        state = client_states[client_socket]
+    for USERNAME, state in sorted(room_roster(room)):
         row = f"{USERNAME:<20} | {state:<10}"
         status_message.append(row)
 
-    final_message = "\n".join(status_message)
-    requesting_client_socket.send(final_message.encode('utf-8'))
+    send_listing(requesting_client_socket, status_message)  # A crowded room's roster takes several frames
+
+def handle_rooms_command(requesting_client_socket):
+    """Handle the !rooms command: send the list of rooms with their number of players and status."""
+    header = f"{'Room':<20} | {'Players':<7} | {'Status':<10}\n" + "-" * 44
+    status_message = [header]
+    for name, room in sorted(rooms.items()):
+        players = len(room['members']) + remote_room_sizes[name]
+        status = 'started' if room['game_active'] else 'waiting'
+        status_message.append(f"{name:<20} | {players:<7} | {status:<10}")
+    send_listing(requesting_client_socket, status_message)
+
+def handle_join_room(client_socket, name):
+    """Handle '!join <room>': leave the current room and enter another one, creating it if needed."""
+    session = clients[client_socket]
+    USERNAME = session.USERNAME
+    current = session.room
+    if current is not None and current['name'] == name:
+        send_to_client(client_socket, f"You are already in {name}.")
+        return
+    room = rooms.get(name)
+    if room is not None and room['game_active'] and client_socket is not moderator_socket:
+        send_to_client(client_socket, f"Game has already started in {name}. Cannot join now.")
+        return
+
+    if current is not None:
+        broadcast_message_to_all(f"{USERNAME} has left the room.", client_socket, room=current)
+        remove_from_room(client_socket, session)
+    created = room is None
+    if created:
+        room = rooms[name] = new_room(name, USERNAME)  # Whoever creates a room moderates it
+        publish('room', room=name, moderator=USERNAME, game_active=False)
+    add_to_room(client_socket, room)
+    publish('state', USERNAME=USERNAME, state=State.ACTIVE.value, room=name)
+    if created:
+        send_to_client(client_socket, f"You created {name} and are its moderator.")
+    else:
+        send_to_client(client_socket, f"You joined {name}.")
+    send_room_history(client_socket, room)
+    broadcast_message_to_all(f"{USERNAME} has joined the room.", client_socket, room=room)
+    logging.info("%s moved to room %s.", USERNAME, name)
+
+
+#-------------------------------------------------#
+# Flood control
+# Every player has a token bucket refilled at RATE_LIMIT messages per second up to RATE_BURST, and the commands
+# of COMMAND_RATES have a bucket of their own. A message that finds its bucket empty is dropped and counts as a
+# strike; FLOOD_SUSPEND_STRIKES strikes suspend the player and FLOOD_BAN_STRIKES ban them.
+
+class TokenBucket:
+    """Allow `rate` events per second on average and `burst` at once; the refill is computed when a token is taken."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+def allow_message(client_socket, session, label=None):
+    """Take a token for a message of a player: from the player's bucket, or from the bucket of a command label.
+
+    Return False when the message must be dropped, after counting the strike. The Admin is never limited.
+    """
+    if RATE_LIMIT <= 0 or client_socket is moderator_socket:
+        return True
+    now = time.monotonic()
+    if label is None:
+        bucket = session.bucket
+        if bucket is None:
+            bucket = session.bucket = TokenBucket(RATE_LIMIT, RATE_BURST, now)
+    else:
+        if label not in COMMAND_RATES:
+            return True
+        if session.command_buckets is None:
+            session.command_buckets = {}
+        bucket = session.command_buckets.get(label)
+        if bucket is None:
+            bucket = session.command_buckets[label] = TokenBucket(*COMMAND_RATES[label], now)
+    if bucket.take(now):
+        return True
+    record_strike(client_socket, session, now)
+    return False
+
+def record_strike(client_socket, session, now):
+    """Count a dropped message and escalate to handle_suspend, then handle_ban, when the player keeps flooding."""
+    increment('messages_throttled')
+    if now - session.strike_time > FLOOD_WINDOW:
+        session.strikes = 0
+    session.strike_time = now
+    session.strikes += 1
+    if session.strikes == 1:
+        send_to_client(client_socket, "You are sending messages too fast, slow down.")
+    if session.strikes == FLOOD_BAN_STRIKES:
+        increment('flood_bans')
+        logging.info("Flood control is banning %s.", session.USERNAME)
+        handle_ban(client_socket)
+    elif session.strikes == FLOOD_SUSPEND_STRIKES and session.state is State.ACTIVE:
+        increment('flood_suspensions')
+        logging.info("Flood control is suspending %s.", session.USERNAME)
+        handle_suspend(client_socket)
 
 
 #-------------------------------------------------#
 # Command processing functions
+# Each command is registered once in COMMANDS with the permission it needs and the parser of its arguments;
+# process_command looks the first word up instead of walking a chain of comparisons. Plain chat never gets
+# here: handle_client_message broadcasts its bytes as they arrived.
 
-def handle_direct_command(client_socket, parts):
-    sender_USERNAME = clients[client_socket]['USERNAME']  # Retrieve sender's USERNAME
-    # Start by identifying if the message is a private message or a command.
-    recipients = []
-    message = []
-    command_flag = False
-    if len(parts[0]) == 1:
-        client_socket.send("Enter a USERNAME.".encode('utf-8'))
-        return
-    for part in parts:
-        if part.startswith('!') and len(message) == 0:  # command detected
-            command_flag = True
-            break
-        elif part.startswith('@'):
-            recipients.append(part[1:])
-        else:
-            message.append(part)
+COMMAND_PREFIXES = (b'!', b'@')  # First byte of a message that is a command or a PM, anything else is chat
 
-    if not recipients:
-        client_socket.send("Enter a valid USERNAME after '@'.".encode('utf-8'))
-        return
+def anyone(client_socket, room):
+    return True
 
-    if command_flag:
-        # This is a command to a specific user.
-        if sender_USERNAME != MODERATOR_USERNAME:
-            client_socket.send("Unauthorized command execution.".encode('utf-8'))
-            return
-        target_client = get_client_by_USERNAME(recipients[0])  # Assuming command to first user only
-        if target_client is None:
-            client_socket.send(f"No such user: {recipients[0]}".encode('utf-8'))
-            return
+def server_moderator(client_socket, room):
+    return client_socket is moderator_socket
 
-        command = parts[1]
-        if command == '!ban':
-            handle_ban(target_client)
-        elif command == '!suspend':
-            handle_suspend(target_client)
-        elif command == '!forgive':
-            handle_forgive(target_client)
-        else:
-            # Suggest corrections for common command typos or prefix matches
-            if 'b' in command:
-                suggestion = "!ban"
-            elif 's' in command:
-                suggestion = "!suspend"
-            elif 'f' in command:
-                suggestion = "!forgive"
-            else:
-                suggestion = None
+def no_arguments(words):
+    return ()  # Extra words after the command are ignored
 
-            if suggestion:
-                client_socket.send(f"Command {command} not found, did you mean: {suggestion}?".encode('utf-8'))
-            else:
-                client_socket.send("Unknown command.".encode('utf-8'))
+def one_argument(words):
+    return (words[0],) if len(words) == 1 else None
 
+def register_command(name, handler, permission=anyone, parse=no_arguments, refusal=None, usage=None):
+    """Add a command to COMMANDS; its handler is called as handler(client_socket, *parse(words))."""
+    COMMANDS[name] = {'handler': handler, 'permission': permission, 'parse': parse, 'refusal': refusal,
+                      'usage': usage, 'label': name[1:]}
+
+COMMANDS = {}
+register_command('!start', handle_start_game, is_room_moderator, refusal="Unauthorized to start the game")
+register_command('!shutdown', lambda client_socket: handle_shutodwn(), server_moderator,
+                 refusal="Unauthorized to shutdown the server")
+register_command('!logout', handle_logout)
+register_command('!list', handle_list_command)
+register_command('!rooms', handle_rooms_command)
+register_command('!join', handle_join_room, parse=one_argument, usage="Usage: !join <room>")
+
+# '@USR !command' runs one of these on USR; only the moderator of USR's room or the Admin may use them.
+# A ban is server-wide and kept by the journal, so '!ban' is left to the Admin.
+MODERATION_COMMANDS = {'!ban': handle_ban, '!suspend': handle_suspend, '!forgive': handle_forgive}
+
+def parse_direct(text):
+    """Split '@USR1 @USR2 words' into the recipients and the rest of the message, kept as it was typed."""
+    recipients = []
+    rest = text
+    while rest.startswith('@'):
+        words = rest.split(None, 1)
+        recipients.append(words[0][1:])
+        rest = words[1] if len(words) == 2 else ''
+    return recipients, rest
+
+def suggest_moderation_command(command):
+    """Suggest the moderation command a typo was probably meant to be."""
+    if 'b' in command:
+        return "!ban"
+    if 's' in command:
+        return "!suspend"
+    if 'f' in command:
+        return "!forgive"
+    return None
+
+def handle_direct_command(client_socket, text):
+    """Handle a message starting with '@': a moderation command or a PM. Return its metrics label."""
+    recipients, rest = parse_direct(text)
+    if not recipients[0]:
+        send_to_client(client_socket, "Enter a USERNAME.")
+        return 'invalid'
+    if not rest.startswith('!'):
+        if not allow_message(client_socket, clients[client_socket], 'pm'):
+            return 'throttled'
+        handle_PM(rest, recipients, clients[client_socket].USERNAME, client_socket)
+        return 'pm'
+
+    # This is a command to a specific user.
+    command = rest.split(None, 1)[0]
+    room = clients[client_socket].room
+    if not is_room_moderator(client_socket, room):
+        send_to_client(client_socket, "Unauthorized command execution.")
+        return 'unauthorized'
+    target_client = get_client_by_USERNAME(recipients[0])  # Assuming command to first user only
+    remote_target = remote_users.get(recipients[0])
+    if target_client is None and remote_target is None:
+        send_to_client(client_socket, f"No such user: {recipients[0]}")
+        return 'invalid'
+    if client_socket is not moderator_socket:
+        # A room moderator only moderates the players of their own room
+        target_room = clients[target_client].room['name'] if target_client is not None and clients[target_client].room else None
+        if remote_target is not None:
+            target_room = remote_target['room']
+        if target_room != room['name']:
+            send_to_client(client_socket, f"{recipients[0]} is not in your room.")
+            return 'unauthorized'
+
+    handler = MODERATION_COMMANDS.get(command)
+    if handler is None:
+        # Suggest corrections for common command typos or prefix matches
+        suggestion = suggest_moderation_command(command)
+        if suggestion:
+            send_to_client(client_socket, f"Command {command} not found, did you mean: {suggestion}?")
+        else:
+            send_to_client(client_socket, "Unknown command.")
+        return 'unknown'
+    if command == '!ban' and client_socket is not moderator_socket:
+        send_to_client(client_socket, "Only the Admin can ban players.")
+        return 'unauthorized'
+    if command in ('!suspend', '!forgive'):
+        # Suspensions belong to a room's game: tell the Admin instead of letting the handler skip it silently
+        target_room = clients[target_client].room if target_client is not None else remote_target['room']
+        if target_room is None:
+            send_to_client(client_socket, f"{recipients[0]} is not in a room.")
+            return 'invalid'
+    if target_client is None:
+        publish('command', USERNAME=recipients[0], command=command)  # Run by the worker hosting the player
     else:
-        handle_PM(message, recipients, sender_USERNAME, client_socket)
+        handler(target_client)
+    return command[1:]
 
 def process_command(client_socket, message):
+    """Run the command or PM of a message whose first byte is in COMMAND_PREFIXES, or refuse a suspended player."""
+    started = time.perf_counter()
+    label = 'invalid'
     try:
-        """Process commands from a client based on the message received."""
-        parts = message.decode('utf-8').strip().split()   # parts is something like ['@User', 'msg'] so it is 2D array
-        command = parts[0]
-        sender_USERNAME = clients[client_socket]['USERNAME']  # Retrieve sender's USERNAME
-
+        session = clients[client_socket]
         # Check if the client is suspended
-        if client_states[client_socket] == 'suspended':
+        if session.state is State.SUSPENDED:
             # Suspended clients should not be able to execute commands
-            client_socket.send("You are suspended and cannot execute commands or send messages.".encode('utf-8'))
+            label = 'suspended'
+            send_to_client(client_socket, "You are suspended and cannot execute commands or send messages.")
             return
 
-
-        # Process commands or logout requests
-        if command in ['!shutdown', '!start'] and sender_USERNAME != MODERATOR_USERNAME:
-            if command == '!shutdown':
-                client_socket.send("Unauthorized to shutdown the server".encode('utf-8'))
-            if command == '!start':
-                client_socket.send("Unauthorized to start the game".encode('utf-8'))
+        text = message.decode('utf-8').strip()
+        if text.startswith('@'):
+            label = handle_direct_command(client_socket, text)
             return
-
-        # Handling commands
-        if command == "!start":
-            handle_start_game()
-        elif command == "!shutdown":
-            handle_shutodwn()
-        elif command == "!logout":
-            handle_logout(client_socket)
-        elif command == "!list":
-            handle_list_command(client_socket)
-        elif command.startswith('@'):
-            handle_direct_command(client_socket, parts)
-        else:
-            logging.info(f"Unknown command received: {command}")
-            client_socket.send("Unknown command.".encode('utf-8'))
+        words = text.split()
+        command = COMMANDS.get(words[0])
+        if command is None:
+            label = 'unknown'
+            logging.info(f"Unknown command received: {words[0]}")
+            send_to_client(client_socket, "Unknown command.")
+            return
+        label = command['label']
+        if not allow_message(client_socket, session, label):
+            label = 'throttled'
+            return
+        if not command['permission'](client_socket, session.room):
+            send_to_client(client_socket, command['refusal'])
+            return
+        arguments = command['parse'](words[1:])
+        if arguments is None:
+            send_to_client(client_socket, command['usage'])
+            return
+        command['handler'](client_socket, *arguments)
     except socket.error as e:
         logging.error("Socket error: " + str(e))
         close_client_connection(client_socket)
@@ -292,121 +1067,657 @@ def process_command(client_socket, message):
     except Exception as e:
         logging.error("Unexpected error: " + str(e))
         # Handle unexpected exceptions
+    finally:
+        observe(f"command_seconds.{label}", time.perf_counter() - started)
 
 
 #-------------------------------------------------#
 # Broadcast functions
 
 def broadcast_message(sender_socket, message):
-    """Broadcast a message to all clients except the sender, including the sender's USERNAME."""
-    sender_USERNAME = clients[sender_socket]['USERNAME']  # Get the USERNAME of the sender
-    full_message = f"{sender_USERNAME}: {message.decode('utf-8')}".encode('utf-8')  # Prepend USERNAME to the message
-    closed_clients = []
-    for client_socket in clients:
-        if client_socket != sender_socket:  # Exclude the sender from receiving the message
-            try:
-                client_socket.send(full_message)  # Send the message to each client
-            except Exception as e:
-                logging.error(f"Failed to send message to {clients[client_socket]['address'][0]}: {str(e)}.")
-                client_socket.close()
-                closed_clients.append(client_socket)
-    # Clean up closed client sockets
-    for client_socket in closed_clients:
-        clients.pop(client_socket, None)
+    """Broadcast a message to the clients of the sender's room except the sender, including the sender's USERNAME."""
+    session = clients[sender_socket]
+    sender_USERNAME = session.USERNAME  # Get the USERNAME of the sender
+    room = session.room
+    if room is None:
+        send_to_client(sender_socket, "You are not in a room. Use !rooms and !join <room>.")
+        return sender_USERNAME
+    # Serialized once: the same immutable frame is shared by every recipient's queue
+    full_message = encode_frame_parts(session.prefix, message)  # Prepend USERNAME to the message
+    for client_socket in room['members']:
+        if client_socket is not sender_socket:  # Exclude the sender from receiving the message
+            queue_frame(client_socket, full_message)  # Queued, written once the socket is writable
+    observe('broadcast_fanout', len(room['members']) - 1, COUNT_BUCKETS)
+    remember_message(room, full_message)  # The same frame object, nothing is copied
+    publish('broadcast', full_message, room=room['name'], chat=True)
     return sender_USERNAME
 
-def broadcast_message_to_all(message, *excluded_clients):
+def broadcast_message_to_all(message, *excluded_clients, room=None):
     """
-    Broadcast a message to all connected clients, with optional exclusions.
-    
+    Broadcast a message to all connected clients, or to the clients of one room, with optional exclusions.
+
     Parameters:
         message (str): The message to broadcast.
         *excluded_clients: Variable number of client sockets to exclude from the broadcast.
+        room (dict): Room to broadcast to, None for every client of the server.
     """
-    full_message = message.encode('utf-8')
+    full_message = encode_frame(message)
     excluded_sockets = set(excluded_clients)  # Convert to set for O(1) look-up times
-    
-    for client_socket in clients:
+
+    fanout = 0
+    for client_socket in (clients if room is None else room['members']):
         if client_socket not in excluded_sockets:  # Only send if not in the excluded list
+            queue_frame(client_socket, full_message)
+            fanout += 1
+    observe('broadcast_fanout', fanout, COUNT_BUCKETS)
+    # Excluded clients are local, the other workers send to everybody in the room
+    publish('broadcast', full_message, room=room and room['name'])
+
+
+#-------------------------------------------------#
+# TLS (--tls-cert)
+# The handshake is driven by the event loop like the login: accepted sockets are wrapped without a handshake
+# and each readable or writable event advances it, then the USERNAME exchange starts. The workers of
+# --workers N are forked after the context is created and share its session ticket keys, so a player
+# reconnecting to any worker resumes its session instead of running a full handshake.
+
+def create_tls_context(certfile, keyfile=None):
+    """Return the server SSLContext: TLS 1.2 or later, issuing session tickets for resumption."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = 1  # TLS 1.3 sends two by default, a client only keeps one
+    return context
+
+def continue_tls_handshake(client_socket, session):
+    """Advance the TLS handshake of a connection without blocking; the login starts once it completes."""
+    try:
+        client_socket.do_handshake()
+    except ssl.SSLWantReadError:
+        events = selectors.EVENT_READ
+    except ssl.SSLWantWriteError:
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE
+    except (ssl.SSLError, OSError) as e:
+        increment('tls_handshakes_failed')
+        logging.info("TLS handshake with %s failed: %s.", session.address[0], e)
+        close_client_connection(client_socket)
+        return
+    else:
+        session.stage = 'username'
+        increment('tls_handshakes')
+        if client_socket.session_reused:
+            increment('tls_sessions_resumed')
+        observe('tls_handshake_seconds', time.monotonic() - (session.deadline - HANDSHAKE_TIMEOUT))
+        events = selectors.EVENT_READ
+    writing = bool(events & selectors.EVENT_WRITE)
+    if writing != session.writing:
+        session.writing = writing
+        selector.modify(client_socket, events)
+
+
+#-------------------------------------------------#
+# Event loop functions
+
+def accept_new_clients():
+    """Accept pending connections without blocking and start their login exchange."""
+    for _ in range(ACCEPT_BATCH):
+        try:
+            client_socket, client_address = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return  # No more connections waiting in the backlog
+        increment('connections_accepted')
+        if len(clients) + len(pending) >= MAX_CONNECTIONS:
+            increment('connections_refused')
             try:
-                client_socket.send(full_message)
-            except Exception as e:
-                logging.error(f"Failed to send message to {clients[client_socket]['address'][0]}: {str(e)}")
-                client_socket.close()
-                clients.pop(client_socket, None)  # Safe removal from dictionary during iteration
+                if tls_context is None:  # A TLS client could not read a plaintext reply
+                    client_socket.send(encode_frame("Server is full. Try again later."))
+            except socket.error:
+                pass
+            client_socket.close()
+            logging.info("Refused a connection, the server is full.")
+            continue
+        client_socket.setblocking(False)  # Output goes through the client's queue, never a blocking send
+        session = Session(client_address)
+        if tls_context is not None:
+            # The handshake is driven by the event loop, see continue_tls_handshake()
+            client_socket = tls_context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+            session.stage = 'tls'
+        deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+        pending[client_socket] = session
+        session.deadline = deadline
+        timers.schedule(client_socket, deadline)
+        selector.register(client_socket, selectors.EVENT_READ)
+
+def handle_handshake_message(client_socket, message):
+    """Advance the login state machine of a connection: awaiting USERNAME -> awaiting password -> joined."""
+    session = pending[client_socket]
+    if not message:
+        return  # Empty frames are heartbeats, never a USERNAME or a password
+
+    if session.stage == 'username':
+        USERNAME = message.decode('utf-8', errors='replace').strip()  # The first message is the USERNAME
+        session.USERNAME = USERNAME
+        if USERNAME == MODERATOR_USERNAME:
+            session.stage = 'password'
+            send_to_client(client_socket, "Enter the password for Admin:")
+            return
+        if not USERNAME:
+            refuse_connection(client_socket, "USERNAME cannot be empty.")
+            logging.info("Refused an empty USERNAME.")
+        elif len(USERNAME.encode('utf-8')) > MAX_USERNAME_SIZE:
+            refuse_connection(client_socket, f"USERNAME is longer than {MAX_USERNAME_SIZE} bytes.")
+            logging.info("Refused a USERNAME of more than %d bytes.", MAX_USERNAME_SIZE)
+        elif USERNAME in banned_usernames:
+            refuse_connection(client_socket, "You have been banned from the game.")
+            logging.info("Banned USERNAME %s tried to log in.", USERNAME)
+        elif USERNAME_in_use(USERNAME):
+            refuse_connection(client_socket, "USERNAME already in use.")
+            logging.info("Attempted to use an existing USERNAME.")
+        else:
+            client_address = session.address
+            session.stage = 'joined'
+            # Confirms the login before anything else (room history, room notices) reaches the client
+            send_to_client(client_socket, f"Welcome, {USERNAME}.")
+            lobby = rooms[DEFAULT_ROOM]
+            remembered = journal.state['players'].get(USERNAME) if journal is not None else None
+            if remembered is not None and remembered['room'] in rooms:
+                # Connected when the server stopped: back into the same room and state, even if its game started
+                room = rooms[remembered['room']]
+                register_client(client_socket, session, room)
+                if remembered['state'] != State.ACTIVE.value:
+                    set_state(client_socket, State(remembered['state']))
+                send_to_client(client_socket, f"Welcome back, you are in {room['name']} and {remembered['state']}.")
+                logging.info("Restored %s into room %s.", USERNAME, room['name'])
+            elif lobby['game_active'] == True:
+                # The player stays connected and can pick another room
+                register_client(client_socket, session, None)
+                send_to_client(client_socket, f"Game has already started in {DEFAULT_ROOM}. Use !rooms and !join <room> to play in another room.")
+                logging.info("Joined after the game in the lobby has started.")
+            else:
+                register_client(client_socket, session, lobby)
+            logging.info("Accepted new connection from %s : %s with USERNAME: %s.", client_address[0], client_address[1], USERNAME)
+
+    elif session.stage == 'password':
+        password = message.decode('utf-8', errors='replace').strip()
+        if password != ADMIN_PASSWORD:
+            refuse_connection(client_socket, "Incorrect password. Connection terminated.")
+            logging.info("Attempted to login as Admin with incorrect password.")
+        elif USERNAME_in_use(MODERATOR_USERNAME):
+            refuse_connection(client_socket, "USERNAME already in use.")
+            logging.info("Attempted to login as Admin while the Admin is connected.")
+        else:
+            send_to_client(client_socket, "Password correct. Welcome, Admin.\n")  # Append a newline to separate from future commands
+            session.stage = 'joined'
+            register_client(client_socket, session, rooms[DEFAULT_ROOM])
+            logging.info("Admin logged in from %s", session.address)
+
+def schedule_liveness_check(client_socket, session):
+    """Start watching a logged in client for silence: its first check is one heartbeat interval away."""
+    session.last_seen = time.monotonic()
+    intervals = [interval for interval in (HEARTBEAT_INTERVAL, IDLE_TIMEOUT) if interval > 0]
+    if intervals:
+        timers.schedule(client_socket, session.last_seen + min(intervals))
+    else:
+        timers.cancel(client_socket)
+
+def check_liveness(client_socket, session, now):
+    """Close a client silent for IDLE_TIMEOUT, ping one silent for HEARTBEAT_INTERVAL, and set its next check.
+
+    Receiving only stores session.last_seen; the timer set here fires at the check it planned and finds out
+    then whether the client spoke in between, so a busy connection costs no timer updates.
+    """
+    silent = now - session.last_seen
+    if IDLE_TIMEOUT > 0 and silent >= IDLE_TIMEOUT:
+        increment('idle_disconnects')
+        logging.info("Closing %s, silent for %.0f seconds.", session.USERNAME, silent)
+        close_client_connection(client_socket)
+        return
+    checks = []
+    if IDLE_TIMEOUT > 0:
+        checks.append(session.last_seen + IDLE_TIMEOUT)
+    if HEARTBEAT_INTERVAL > 0:
+        if silent >= HEARTBEAT_INTERVAL:
+            increment('pings_sent')
+            queue_frame(client_socket, HEARTBEAT)
+            checks.append(now + HEARTBEAT_INTERVAL)
+        else:
+            checks.append(session.last_seen + HEARTBEAT_INTERVAL)
+    timers.schedule(client_socket, min(checks))
+
+def expire_timers():
+    """Time out the logins and check the liveness of the clients whose timer is due."""
+    now = time.monotonic()
+    for client_socket in timers.expire(now):
+        session = pending.get(client_socket)
+        if session is not None:
+            increment('handshakes_timed_out')
+            logging.info("Login from %s timed out.", session.address[0])
+            refuse_connection(client_socket, "Login timed out. Connection terminated.")
+            continue
+        session = clients.get(client_socket)
+        if session is not None:
+            check_liveness(client_socket, session, now)
+
+async def timer_ticker():
+    """Expire the timers of the asyncio engine once per tick of the wheel."""
+    while True:
+        await asyncio.sleep(timers.wait_time(time.monotonic()) or timers.tick)
+        expire_timers()
+
+def handle_client_message(notified_socket, message):
+    """Dispatch one message from a registered client."""
+    if not message:
+        return  # A pong: receiving it was enough, see check_liveness()
+    if not allow_message(notified_socket, clients[notified_socket]):
+        return  # Dropped by flood control
+    if message[:1] in COMMAND_PREFIXES or clients[notified_socket].state is State.SUSPENDED:
+        process_command(notified_socket, message)
+    else:
+        # Plain chat: the received bytes are broadcast as they are, never decoded
+        started = time.perf_counter()
+        sender = broadcast_message(notified_socket, message)
+        observe('broadcast_seconds', time.perf_counter() - started)
+        if sample_debug():
+            logging.debug("Broadcasted message from %s, message: %s.", sender, message.decode('utf-8', errors='replace'))
+
+def handle_received_data(client_socket, data):
+    """Handle each complete frame of a chunk of received bytes in order, whichever engine read it."""
+    session = clients.get(client_socket) or pending[client_socket]
+    session.last_seen = time.monotonic()  # Any bytes prove the client is alive, see check_liveness()
+    messages = session.decoder.feed(data)
+    increment('bytes_in', len(data))
+    increment('messages_in', len(messages))
+    for message in messages:
+        if client_socket in pending:
+            handle_handshake_message(client_socket, message)
+        elif client_socket in clients:
+            handle_client_message(client_socket, message)
+        else:
+            break  # The connection was closed by an earlier frame of this batch
+
+def handle_readable(notified_socket):
+    """Read everything available on a connection and handle each complete frame in order."""
+    session = clients.get(notified_socket) or pending[notified_socket]
+    if session.stage == 'tls':
+        continue_tls_handshake(notified_socket, session)
+        return
+    USERNAME = session.USERNAME
+    try:
+        # A TLS record carries at most 16 KiB, so one recv() of RECV_SIZE leaves nothing decrypted
+        # inside the SSLSocket where the selector could not see it
+        data = notified_socket.recv(RECV_SIZE)
+        if not data:
+            # No data means the client has disconnected
+            logging.info("Closed connection from %s of address %s.", USERNAME, session.address[0])
+            close_client_connection(notified_socket)
+            return
+        handle_received_data(notified_socket, data)
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+        return  # Only part of a TLS record has arrived
+    except FrameError as e:
+        logging.error(f"Protocol error from {USERNAME} of address {session.address[0]}: {str(e)}.")
+        close_client_connection(notified_socket)
+    except Exception as e:
+        logging.error(f"Error handling message from {USERNAME}: {str(e)}.")
+        close_client_connection(notified_socket)
+
+
+#-------------------------------------------------#
+# Multi-process mode (--workers N)
+
+def handle_broker_envelope(header, body):
+    """Apply a change published by another worker to this worker's mirror and local players."""
+    kind = header['kind']
+    if kind == 'sync':
+        for name, room in header['rooms'].items():
+            update_room(name, room['moderator'], room['game_active'])
+        for USERNAME, entry in header['directory'].items():
+            if entry['worker'] != worker_id:
+                set_remote_user(USERNAME, entry['state'], entry['room'])
+    elif kind == 'join' or kind == 'state':
+        set_remote_user(header['USERNAME'], header['state'], header['room'])
+    elif kind == 'leave':
+        drop_remote_user(header['USERNAME'])
+    elif kind == 'room':
+        update_room(header['room'], header['moderator'], header['game_active'])
+    elif kind == 'broadcast':
+        room = rooms.get(header['room']) if header['room'] is not None else None
+        if header['room'] is None or room is not None:
+            for client_socket in (clients if room is None else room['members']):
+                queue_frame(client_socket, body)  # The frame was encoded once by the worker that sent it
+            if room is not None and header.get('chat'):
+                remember_message(room, body)
+    elif kind == 'deliver':
+        target_client = get_client_by_USERNAME(header['USERNAME'])
+        if target_client is not None:
+            queue_frame(target_client, body)
+    elif kind == 'command':
+        target_client = get_client_by_USERNAME(header['USERNAME'])
+        MODERATION_COMMANDS[header['command']](target_client)
+    elif kind == 'ban':
+        banned_usernames.add(header['USERNAME'])
+    elif kind == 'evict':
+        # Another worker accepted the same USERNAME first
+        target_client = get_client_by_USERNAME(header['USERNAME'])
+        if target_client is not None:
+            refuse_connection(target_client, "USERNAME already in use.")
+    elif kind == 'shutdown':
+        handle_shutodwn(notify_workers=False)
+
+def update_room(name, moderator, game_active):
+    """Create or update the record of a room announced by another worker."""
+    room = rooms.get(name)
+    if room is None:
+        room = rooms[name] = new_room(name, moderator)
+    room['moderator'] = moderator
+    room['game_active'] = game_active
+
+def handle_broker_readable():
+    """Read the envelopes relayed by the broker."""
+    data = broker_link.recv(RECV_SIZE)
+    if not data:
+        logging.error("Lost the connection to the broker.")
+        handle_shutodwn(notify_workers=False)
+    for frame in broker_decoder.feed(data):
+        handle_broker_envelope(*decode_envelope(frame))
+
+def start_worker(number, broker_path):
+    """Entry point of a forked worker: join the broker, then run the selectors engine on the shared port."""
+    global worker_id, broker_link
+    worker_id = number
+    broker_link = connect_to_broker(broker_path, number)
+    logging.info(f"Worker {number} started with pid {os.getpid()}.")
+    start_server()
+
+def start_workers(count):
+    """Fork the worker processes and run the broker that links them in this process."""
+    broker_path = os.path.join(tempfile.gettempdir(), f"chat_killer_{SERVER_PORT}.sock")
+    listener = create_broker_socket(broker_path)
+    children = []
+    for number in range(count):
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            try:
+                start_worker(number, broker_path)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)  # 'kill -USR1' on the process group makes every worker dump its metrics
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    run_broker(listener, broker_path, {DEFAULT_ROOM: {'moderator': MODERATOR_USERNAME, 'game_active': False}})
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+#-------------------------------------------------#
+# asyncio engine (--async)
+# The connection key in clients/pending is the StreamWriter, every command handler above is shared as is.
+
+async def async_writer(writer, session):
+    """Move a connection's queued frames into its transport, waiting on drain() when the peer is slow."""
+    wakeup = session.wakeup
+    outbox = session.outbox
+    while True:
+        await wakeup.wait()
+        wakeup.clear()
+        if session.overflowed:
+            close_client_connection(writer)
+            return
+        if outbox:
+            batch = list(outbox)
+            outbox.clear()
+            session.outbox_bytes = 0
+            increment('bytes_out', sum(len(frame) for frame in batch))
+            observe('frames_per_send', len(batch), COUNT_BUCKETS)
+            writer.writelines(batch)
+            try:
+                await writer.drain()  # Backpressure: new frames keep queuing in the outbox meanwhile
+            except (ConnectionError, OSError):
+                increment('send_failures')
+                close_client_connection(writer)
+                return
+
+async def handle_async_connection(reader, writer):
+    """Run the login exchange and message loop of one connection accepted by the asyncio engine."""
+    client_address = writer.get_extra_info('peername')
+    increment('connections_accepted')
+    if len(clients) + len(pending) >= MAX_CONNECTIONS:
+        increment('connections_refused')
+        writer.write(encode_frame("Server is full. Try again later."))
+        writer.close()
+        logging.info("Refused a connection, the server is full.")
+        return
+    ssl_object = writer.get_extra_info('ssl_object')
+    if ssl_object is not None:  # asyncio completed the TLS handshake before calling this
+        increment('tls_handshakes')
+        if ssl_object.session_reused:
+            increment('tls_sessions_resumed')
+    session = Session(client_address)
+    session.deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+    session.wakeup = asyncio.Event()
+    pending[writer] = session
+    timers.schedule(writer, session.deadline)  # The login timeout and liveness checks are run by timer_ticker()
+    writer_task = asyncio.create_task(async_writer(writer, session))
+    try:
+        while writer in pending or writer in clients:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                if writer in pending or writer in clients:
+                    logging.info("Closed connection from %s of address %s.", session.USERNAME, client_address[0])
+                break
+            handle_received_data(writer, data)
+    except FrameError as e:
+        logging.error(f"Protocol error from {session.USERNAME} of address {client_address[0]}: {str(e)}.")
+    except (ConnectionError, OSError) as e:
+        logging.error(f"Error handling message from {session.USERNAME}: {str(e)}.")
+    finally:
+        writer_task.cancel()
+        close_client_connection(writer)
+
+async def handle_async_stats(reader, writer):
+    """Answer a connection on the stats port with a JSON snapshot."""
+    writer.write(encode_snapshot(metrics_gauges()))
+    await writer.drain()
+    writer.close()
+
+async def serve_async():
+    """Accept connections with asyncio streams, one task per connection."""
+    server = await asyncio.start_server(handle_async_connection, SERVER_IP, SERVER_PORT,
+                                        backlog=LISTEN_BACKLOG, reuse_address=True, ssl=tls_context,
+                                        ssl_handshake_timeout=HANDSHAKE_TIMEOUT if tls_context else None)
+    if STATS_PORT is not None:
+        await asyncio.start_server(handle_async_stats, SERVER_IP, STATS_PORT, reuse_address=True)
+    if journal is not None:
+        asyncio.create_task(journal_flusher())
+    asyncio.create_task(timer_ticker())
+    async with server:
+        await server.serve_forever()
+
+def start_async_server():
+    raise_open_files_limit()
+    install_metrics_signal()
+    install_logging_signal()
+    start_log_queue()
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logging.info("Using the uvloop event loop.")
+    try:
+        asyncio.run(serve_async())
+    except Exception as e:
+        logging.error(f"Fatal error in server main loop: {str(e)}.")
+    finally:
+        logging.info("Server shutting down...")
+        close_journal()
+        stop_log_queue()
 
 
 #-------------------------------------------------#
 # Main function to start the server
 
 def start_server():
+    global server_socket, selector, stats_socket
+    raise_open_files_limit()
+    install_metrics_signal()
+    install_logging_signal()
+    start_log_queue()  # After fork(), every worker runs its own listener thread
+    selector = selectors.DefaultSelector()
+    server_socket = create_server_socket()
+    selector.register(server_socket, selectors.EVENT_READ)
+    if broker_link is not None:
+        selector.register(broker_link, selectors.EVENT_READ)
+    if STATS_PORT is not None:
+        stats_socket = create_stats_socket()
+        selector.register(stats_socket, selectors.EVENT_READ)
     try:
         while True:
-            # Use select to handle multiple clients
-            read_sockets, _, exception_sockets = select.select([server_socket] + list(clients.keys()), [], list(clients.keys()))
-
-            for notified_socket in read_sockets:
-                if notified_socket == server_socket:
-                    client_socket, client_address = server_socket.accept()
-                    USERNAME = client_socket.recv(1024).decode('utf-8').strip()  # Assume the first message is the USERNAME
-                    
-                    if USERNAME == MODERATOR_USERNAME:
-                        client_socket.send(b"Enter the password for Admin:")
-                        password = client_socket.recv(1024).decode('utf-8').strip()
-                        if password != "admin123":  
-                            client_socket.send(b"Incorrect password. Connection terminated.")
-                            logging.info("Attempted to login as Admin with incorrect password.")
-                            client_socket.close()
-                            continue
-                        else:
-                            client_socket.send(b"Password correct. Welcome, Admin.\n")  # Append a newline to separate from future commands
-                            clients[client_socket] = {'address': client_address, 'USERNAME': USERNAME, 'state': 'active'}
-                            logging.info(f"Admin logged in from {client_address}")
-                            continue  # Skip to the next iteration to prevent sending an extra prompt
-                    
-                    if USERNAME in [clients[sock]['USERNAME'] for sock in clients]:
-                        client_socket.send(b"USERNAME already in use.")
-                        logging.info("Attempted to use an existing USERNAME.")
-                        client_socket.close()
-                    elif game_active == True:
-                        client_socket.send(b"Game has already started. Cannot join now.")
-                        logging.info("Attempted to join after game has started.")
-                        client_socket.close()
-                    else:
-                        clients[client_socket] = {'address': client_address, 'data': [], 'USERNAME': USERNAME}
-                        logging.info(f"Accepted new connection from {client_address[0]} : {client_address[1]} with USERNAME: {USERNAME}.")
-                else:
-                    try:
-                        message = notified_socket.recv(1024)
-                        if message:
-                            if client_states[notified_socket] == 'suspended':
-                                process_command(notified_socket, message)
-                            elif message.startswith(b'!') or b'@' in message: 
-                                process_command(notified_socket, message)
-                            else:
-                                # Broadcast the message to other clients
-                                sender = broadcast_message(notified_socket, message)
-                                logging.debug(f"Broadcasted message from {sender}, message: {message.decode('utf-8')}.")
-                        else:
-                            # No message means the client has disconnected
-                            logging.info(f"Closed connection from {USERNAME} of address {clients[notified_socket]['address'][0]}.")
-                            clients.pop(notified_socket)
-                            notified_socket.close()
-                    except Exception as e:
-                        logging.error(f"Error handling message from {USERNAME} of address {clients[notified_socket]['address'][0]}: {str(e)}.")
-                        clients.pop(notified_socket)
-                        notified_socket.close()
-
-            for notified_socket in exception_sockets:
-                close_client_connection(notified_socket)
-                
+            # Each socket is registered once, so a wakeup only costs the number of ready sockets
+            events = selector.select(timers.wait_time(time.monotonic()))
+            started = time.perf_counter()
+            for key, mask in events:
+                notified_socket = key.fileobj
+                if notified_socket is server_socket:
+                    accept_new_clients()
+                    continue
+                if notified_socket is stats_socket:
+                    answer_stats_request()
+                    continue
+                if notified_socket is broker_link:
+                    handle_broker_readable()
+                    continue
+                if mask & selectors.EVENT_WRITE and (notified_socket in clients or notified_socket in pending):
+                    handle_writable(notified_socket)
+                if mask & selectors.EVENT_READ and (notified_socket in clients or notified_socket in pending):  # Skip sockets closed earlier in this batch
+                    handle_readable(notified_socket)
+            expire_timers()  # Only the slots of the ticks that passed, whatever the number of connections
+            # Journal first: a reply the players see is never ahead of what a restart restores
+            flush_journal()
+            # Everything queued while handling these events is written in one pass per client
+            flush_dirty_clients()
+            observe('loop_busy_seconds', time.perf_counter() - started)
+            observe('events_per_wakeup', len(events), COUNT_BUCKETS)
+
     except Exception as e:
         logging.error(f"Fatal error in server main loop: {str(e)}.")
     finally:
         logging.info("Server shutting down...")
-        server_socket.close()
-        for client_socket in list(clients.keys()):
+        close_journal()
+        for client_socket in list(clients.keys()) + list(pending.keys()):
             close_client_connection(client_socket)
+        selector.close()
+        server_socket.close()
+        if stats_socket is not None:
+            stats_socket.close()
+        stop_log_queue()
+
+def parse_arguments(argv):
+    """Parse the command-line arguments of the server."""
+    parser = argparse.ArgumentParser(prog="python3 chat_killer_server.py", description="Chat killer game server.")
+    parser.add_argument('port', type=int, help="port number to listen on")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="run the asyncio engine (uses uvloop when it is installed)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port through SO_REUSEPORT")
+    parser.add_argument('--log-level', default='DEBUG', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="lowest level written to the log (default: %(default)s); SIGUSR2 toggles DEBUG")
+    parser.add_argument('--log-queue', action='store_true',
+                        help="format and write the log on a background thread instead of in the event loop")
+    parser.add_argument('--debug-sample', type=int, default=1, metavar='N',
+                        help="write the debug line of one chat message out of N (default: %(default)s)")
+    parser.add_argument('--journal', metavar='DIR',
+                        help="keep an append-only journal in DIR and restore rooms, players and bans from it on start")
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='interval',
+                        help="when the journal is synced to disk: every batch, about once a second or never "
+                             "(default: %(default)s)")
+    parser.add_argument('--stats-port', type=int,
+                        help="local port serving a JSON snapshot of the metrics (worker N uses STATS_PORT + N)")
+    parser.add_argument('--tls-cert', metavar='FILE',
+                        help="serve TLS with this PEM certificate chain (it may also hold the private key)")
+    parser.add_argument('--tls-key', metavar='FILE', help="PEM private key of --tls-cert")
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT, metavar='SECONDS',
+                        help="time a new connection has to complete the TLS and login exchange (default: %(default)s)")
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL, metavar='SECONDS',
+                        help="ping a client after this much silence, 0 to never ping (default: %(default)s)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, metavar='SECONDS',
+                        help="close a client that sent nothing, pongs included, for this long, 0 to never close "
+                             "(default: %(default)s)")
+    parser.add_argument('--outbox-high-water', type=int, default=OUTBOX_HIGH_WATER, metavar='BYTES',
+                        help="bytes that may wait to be sent to one client before it is a slow consumer "
+                             "(default: %(default)s)")
+    parser.add_argument('--slow-consumer', choices=['disconnect', 'drop'], default=SLOW_CONSUMER_POLICY,
+                        help="what happens to a slow consumer: it is disconnected, or the messages it cannot take "
+                             "are dropped (default: %(default)s)")
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT, metavar='RATE',
+                        help="messages per second a player may send on average, 0 to disable flood control "
+                             "(default: %(default)s)")
+    parser.add_argument('--rate-burst', type=int, default=RATE_BURST, metavar='BURST',
+                        help="messages a player may send at once (default: %(default)s)")
+    parser.add_argument('--flood-suspend', type=int, default=FLOOD_SUSPEND_STRIKES, metavar='STRIKES',
+                        help="messages dropped by flood control that suspend a player, 0 to never suspend "
+                             "(default: %(default)s)")
+    parser.add_argument('--flood-ban', type=int, default=FLOOD_BAN_STRIKES, metavar='STRIKES',
+                        help="messages dropped by flood control that ban a player, 0 to never ban "
+                             "(default: %(default)s)")
+    arguments = parser.parse_args(argv)
+    if arguments.workers < 1:
+        parser.error("--workers must be at least 1")
+    if arguments.debug_sample < 1:
+        parser.error("--debug-sample must be at least 1")
+    if arguments.tls_key and not arguments.tls_cert:
+        parser.error("--tls-key needs --tls-cert")
+    if arguments.handshake_timeout <= 0:
+        parser.error("--handshake-timeout must be positive")
+    if 0 < arguments.idle_timeout <= arguments.heartbeat:
+        parser.error("--idle-timeout must be longer than --heartbeat, or the clients are closed before being pinged")
+    if arguments.outbox_high_water < MAX_FRAME_SIZE:
+        parser.error(f"--outbox-high-water must be at least {MAX_FRAME_SIZE}, the largest frame")
+    if arguments.rate_burst < 1:
+        parser.error("--rate-burst must be at least 1")
+    if arguments.workers > 1 and arguments.use_async:
+        parser.error("--workers runs the selectors engine in every worker and cannot be combined with --async")
+    if arguments.workers > 1 and arguments.journal:
+        parser.error("--journal is written by a single process and cannot be combined with --workers")
+    return arguments
+
+def main(argv=None):
+    global SERVER_PORT, async_mode, STATS_PORT, LOG_LEVEL, LOG_QUEUE, DEBUG_SAMPLE_RATE, JOURNAL_DIR, JOURNAL_FSYNC
+    global RATE_LIMIT, RATE_BURST, FLOOD_SUSPEND_STRIKES, FLOOD_BAN_STRIKES, tls_context
+    global HANDSHAKE_TIMEOUT, HEARTBEAT_INTERVAL, IDLE_TIMEOUT, OUTBOX_HIGH_WATER, SLOW_CONSUMER_POLICY
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
+    SERVER_PORT = arguments.port
+    STATS_PORT = arguments.stats_port
+    LOG_LEVEL = logging.getLevelName(arguments.log_level)
+    LOG_QUEUE = arguments.log_queue
+    DEBUG_SAMPLE_RATE = arguments.debug_sample
+    RATE_LIMIT = arguments.rate_limit
+    RATE_BURST = arguments.rate_burst
+    FLOOD_SUSPEND_STRIKES = arguments.flood_suspend
+    FLOOD_BAN_STRIKES = arguments.flood_ban
+    HANDSHAKE_TIMEOUT = arguments.handshake_timeout
+    HEARTBEAT_INTERVAL = arguments.heartbeat
+    IDLE_TIMEOUT = arguments.idle_timeout
+    OUTBOX_HIGH_WATER = arguments.outbox_high_water
+    SLOW_CONSUMER_POLICY = arguments.slow_consumer
+    logging.getLogger().setLevel(LOG_LEVEL)
+    JOURNAL_DIR = arguments.journal
+    JOURNAL_FSYNC = arguments.fsync
+    if JOURNAL_DIR is not None:
+        open_journal()
+    if arguments.tls_cert:
+        try:
+            tls_context = create_tls_context(arguments.tls_cert, arguments.tls_key)
+        except (OSError, ssl.SSLError) as e:
+            logging.error(f"Could not load the TLS certificate: {str(e)}.")
+            sys.exit(1)
+    async_mode = arguments.use_async
+    logging.info(f"Server started on {SERVER_IP} : {SERVER_PORT}.")
+    if async_mode:
+        start_async_server()
+    elif arguments.workers > 1:
+        start_workers(arguments.workers)
+    else:
+        start_server()
 
 
 #-------------------------------------------------#
@@ -415,5 +1726,5 @@ def start_server():
 
 #-------------------------------------------------#
 if __name__ == "__main__":                        #
-    start_server()                                #
-#-------------------------------------------------# 
\ No newline at end of file
+    main()                                        #
+#-------------------------------------------------#
@@ -0,0 +1,63 @@
+# Timer wheel of the chat killer server
+#
+# Every connection has at most one timer: its login deadline while it logs in, then the next time its
+# liveness must be checked (see the heartbeats in chat_killer_server.py). The wheel is a ring of slots, one
+# per tick; scheduling, replacing or cancelling a timer is a dictionary update, and each tick only looks at
+# the timers of its own slot, so tens of thousands of idle connections cost nothing until they are due.
+import math
+
+
+#-------------------------------------------------#
+# Wheel configuration
+
+TICK = 0.5  # Seconds per slot: the precision of every timeout
+SLOTS = 1024  # Slots in the ring; a timer further away than SLOTS * TICK waits extra turns in its slot
+
+
+class TimerWheel:
+    """Deadlines keyed by connection, at most one per key, found tick by tick instead of by scanning every key."""
+
+    def __init__(self, now, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # Slot -> {key: deadline}
+        self.where = {}  # Key -> slot index, to replace or cancel a timer in O(1)
+        self.current = math.floor(now / tick)  # Last tick whose slot has been expired
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, deadline):
+        """Set the timer of key to deadline, replacing the one it had."""
+        self.cancel(key)
+        tick = max(math.ceil(deadline / self.tick), self.current + 1)
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def expire(self, now):
+        """Remove and return the keys whose deadline is at or before now, in tick order."""
+        target = math.floor(now / self.tick)
+        due = []
+        # After a long stall every slot is visited once, not once per missed tick
+        for tick in range(max(self.current + 1, target - len(self.slots) + 1), target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            for key, deadline in list(slot.items()):
+                if deadline <= now:  # Later ones belong to a further turn of the wheel
+                    del slot[key]
+                    del self.where[key]
+                    due.append(key)
+        self.current = max(self.current, target)
+        return due
+
+    def wait_time(self, now):
+        """Return the seconds until the next tick, or None when no timer is set."""
+        if not self.where:
+            return None
+        return max((self.current + 1) * self.tick - now, 0)